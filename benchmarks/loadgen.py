@@ -0,0 +1,733 @@
+"""Load generator and benchmark scenarios for the websocket service.
+
+This runs the service in-process behind a real gevent WSGI server on
+loopback, feeds it from a fake message source standing in for AMQP, and
+drives it with thousands of simulated websocket clients.  Each scenario
+prints one JSON object per line so that runs can be saved and compared:
+
+    python -m benchmarks.loadgen --clients 5000 > before.json
+    (make some changes)
+    python -m benchmarks.loadgen --clients 5000 > after.json
+    python -m benchmarks.loadgen --compare before.json after.json
+
+Clients and server share one process and one hub, so CPU and memory figures
+cover both sides of every connection.  They are meant for comparing runs
+against each other, not as absolute capacity numbers.
+
+Pass `--tls native` to have the server terminate TLS itself (with a
+self-signed certificate), or `--tls proxied` to put a TLS-terminating
+forwarder on loopback in front of the plain server, and compare either with a
+plain run.  The forwarder runs in the same process, so the proxied figures
+include its sockets and buffers for every connection, though a purpose-built
+proxy would be leaner than it.  The `tls_resumption` scenario always uses TLS
+(natively unless told otherwise) and drives handshakes with `openssl s_time`,
+since python 2 clients can't resume sessions.
+
+"""
+import argparse
+import base64
+import datetime
+import gc
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+import urllib
+from distutils.spawn import find_executable
+from zlib import decompressobj, MAX_WBITS
+
+import gevent
+import gevent.event
+import gevent.pool
+import gevent.pywsgi
+import gevent.server
+import gevent.socket
+import gevent.subprocess
+from gevent import ssl
+
+from baseplate.crypto import make_signature
+
+from reddit_service_websockets.app import make_app
+from reddit_service_websockets.server import make_ssl_context
+from reddit_service_websockets.socketserver import WebSocketHandler
+from reddit_service_websockets.source import BaseMessageSource
+from reddit_service_websockets.unix_source import encode_frame
+
+
+SECRETS_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, "example_secrets.json")
+CERTIFICATE_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, "tests", "functional",
+    "selfsigned.pem")
+
+# every payload starts with the time it was published, formatted to exactly
+# this many characters, so that clients can measure delivery latency.
+TIMESTAMP_WIDTH = 17
+
+# the bare minimum make_app needs. everything else is left at its default so
+# that benchmarks run what production runs unless told otherwise.
+APP_CONFIG = {
+    "metrics.namespace": "websockets.bench",
+    "secrets.path": SECRETS_PATH,
+    "web.ping_interval": "45",
+    "web.admin_auth": "bench",
+    "web.conn_shed_rate": "1000",
+}
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+
+FILLER = "the quick brown fox jumps over the lazy dog. "
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * resource.getpagesize()
+    except IOError:
+        # ru_maxrss is the peak rather than the current value, and is in
+        # kilobytes on linux, but it's the best we can do elsewhere.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_payload(size):
+    timestamp = "%0*.6f" % (TIMESTAMP_WIDTH, time.time())
+    filler_size = max(size - TIMESTAMP_WIDTH - 1, 0)
+    repeats = filler_size // len(FILLER) + 1
+    return timestamp + " " + (FILLER * repeats)[:filler_size]
+
+
+class FakeMessageSource(BaseMessageSource):
+    """An in-process stand-in for the AMQP `MessageSource`."""
+
+    def __init__(self):
+        super(FakeMessageSource, self).__init__()
+        self.status_messages = 0
+
+    @property
+    def connected(self):
+        return True
+
+    def publish(self, namespace, message):
+        self.message_handler(namespace=namespace, message=message)
+
+    def get_stats(self):
+        return {
+            "connected": True,
+            "messages_received": None,
+            "broker_lag": None,
+        }
+
+    def send_message(self, key, payload):
+        # serialize like the real thing would so that connect/disconnect
+        # status messages cost about what they do in production.
+        json.dumps(payload).encode("utf-8")
+        self.status_messages += 1
+
+    def pump_messages(self):
+        pass
+
+
+class UnixSocketPublisher(object):
+    """Feeds a real `UnixSocketMessageSource` as a local publisher would."""
+
+    def __init__(self, source, timeout=5):
+        deadline = time.time() + timeout
+        while not source.connected:
+            if time.time() > deadline:
+                raise Exception("unix socket source never started listening")
+            gevent.sleep(0.01)
+
+        self.socket = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(source.path)
+
+    def publish(self, namespace, message):
+        self.socket.sendall(encode_frame(namespace, message))
+
+    def stop(self):
+        self.socket.close()
+
+
+class DeliveryStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.deliveries = 0
+        self.closes = 0
+        self.errors = 0
+        self.expected = None
+        self.done = gevent.event.Event()
+
+    def record_delivery(self, payload):
+        sent = float(payload[:TIMESTAMP_WIDTH])
+        self.latencies.append(time.time() - sent)
+        self.deliveries += 1
+        if self.expected is not None and self.deliveries >= self.expected:
+            self.done.set()
+
+    def summarize(self, elapsed):
+        latencies = sorted(self.latencies)
+        p50 = _percentile(latencies, 0.5)
+        p99 = _percentile(latencies, 0.99)
+        return {
+            "deliveries": self.deliveries,
+            "errors": self.errors,
+            "msgs_per_sec": self.deliveries / elapsed if elapsed else None,
+            "latency_p50_ms": p50 * 1000 if p50 is not None else None,
+            "latency_p99_ms": p99 * 1000 if p99 is not None else None,
+        }
+
+
+def _pipe(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                return
+            destination.sendall(data)
+    except socket.error:
+        return
+
+
+class TLSForwarder(object):
+    """A TLS-terminating proxy on loopback that forwards to `backend`."""
+
+    def __init__(self, backend, ssl_context):
+        self.backend = backend
+        self.server = gevent.server.StreamServer(
+            ("127.0.0.1", 0), self.handle, ssl_context=ssl_context)
+        self.server.start()
+        self.address = self.server.address
+
+    def handle(self, client, address):
+        upstream = gevent.socket.create_connection(self.backend)
+        pipes = [gevent.spawn(_pipe, client, upstream),
+                 gevent.spawn(_pipe, upstream, client)]
+        try:
+            # either side hanging up ends the whole connection
+            gevent.joinall(pipes, count=1)
+        finally:
+            gevent.killall(pipes)
+            upstream.close()
+
+    def stop(self):
+        self.server.stop(timeout=1)
+
+
+class SimulatedClient(object):
+    """A minimal websocket client that records what it receives."""
+
+    def __init__(self, harness, namespace, compression):
+        self.harness = harness
+        self.namespace = namespace
+        self.compression = compression
+        self.socket = None
+        self.reader = None
+        self.greenlet = None
+        self.decompressor = decompressobj(-MAX_WBITS)
+
+    def connect(self):
+        self.socket = gevent.socket.create_connection(self.harness.address)
+        if self.harness.client_ssl_context:
+            self.socket = self.harness.client_ssl_context.wrap_socket(
+                self.socket)
+        self.socket.sendall(self.harness.make_handshake(
+            self.namespace, self.compression))
+
+        self.reader = self.socket.makefile("rb")
+        status_line = self.reader.readline()
+        if " 101 " not in status_line:
+            raise Exception("handshake failed: %r" % status_line)
+        while self.reader.readline() not in ("\r\n", ""):
+            pass
+
+    def _read_frame(self):
+        header = self.reader.read(2)
+        if len(header) < 2:
+            return OPCODE_CLOSE, ""
+
+        first, second = struct.unpack("!BB", header)
+        opcode = first & 0x0f
+        compressed = first & 0x40
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self.reader.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.reader.read(8))[0]
+
+        payload = self.reader.read(length)
+        if compressed:
+            payload = self.decompressor.decompress(payload + "\x00\x00\xff\xff")
+        return opcode, payload
+
+    def run(self, stats):
+        try:
+            while True:
+                opcode, payload = self._read_frame()
+                if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                    stats.record_delivery(payload)
+                elif opcode == OPCODE_CLOSE:
+                    stats.closes += 1
+                    break
+        except (IOError, ValueError, struct.error):
+            stats.errors += 1
+        finally:
+            self._close_socket()
+
+    def _close_socket(self):
+        # file objects made by ssl sockets can't be closed twice
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def close(self):
+        if self.greenlet:
+            self.greenlet.kill()
+        self._close_socket()
+
+
+class Harness(object):
+    """The service, as built by `make_app`, on a loopback port.
+
+    `app_config` overrides or adds to `APP_CONFIG`, e.g. to benchmark with
+    coalescing rules or the hub monitor turned off.  `tls` is "native" for the
+    server to terminate TLS, "proxied" for a `TLSForwarder` to terminate it in
+    front of the server, or None for plain connections.
+
+    """
+
+    def __init__(self, source="fake", tls=None, app_config=None):
+        raw_config = dict(APP_CONFIG)
+        raw_config.update(app_config or {})
+
+        self.directory = None
+        if source == "unix":
+            self.directory = tempfile.mkdtemp()
+            raw_config["source.backend"] = "unix"
+            raw_config["unix.directory"] = self.directory
+            self.app = make_app(raw_config)
+            self.source = self.app.message_source
+            self.publisher = UnixSocketPublisher(self.source)
+        else:
+            self.publisher = self.source = FakeMessageSource()
+            self.app = make_app(raw_config, source=self.source)
+
+        server_kwargs = {}
+        self.ssl_context = self.client_ssl_context = None
+        if tls:
+            self.ssl_context = make_ssl_context(CERTIFICATE_PATH)
+            self.client_ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        if tls == "native":
+            self.app.ssl_context = self.ssl_context
+            server_kwargs["ssl_context"] = self.ssl_context
+
+        self.server = gevent.pywsgi.WSGIServer(
+            ("127.0.0.1", 0),
+            self.app,
+            handler_class=WebSocketHandler,
+            log=None,
+            error_log=None,
+            **server_kwargs
+        )
+        self.server.start()
+        self.address = self.server.address
+
+        self.forwarder = None
+        if tls == "proxied":
+            self.forwarder = TLSForwarder(self.address, self.ssl_context)
+            self.address = self.forwarder.address
+
+        self.clients = []
+        self.client_greenlets = gevent.pool.Group()
+        self._signatures = {}
+
+    def make_handshake(self, namespace, compression):
+        if namespace not in self._signatures:
+            secret = self.app.secrets.get_versioned(
+                "secret/websockets/authorization_key")
+            signature = make_signature(
+                secret, namespace, max_age=datetime.timedelta(days=1))
+            self._signatures[namespace] = urllib.quote(signature)
+
+        lines = [
+            "GET %s?m=%s HTTP/1.1" % (namespace, self._signatures[namespace]),
+            "Host: %s:%d" % self.address,
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Key: %s" % base64.b64encode(os.urandom(16)),
+            "Sec-WebSocket-Version: 13",
+        ]
+        if compression:
+            lines.append("Sec-WebSocket-Extensions: permessage-deflate")
+        return "\r\n".join(lines) + "\r\n\r\n"
+
+    def connect_clients(self, count, namespace, stats, compression=False,
+                        concurrency=200):
+        """Connect `count` clients and start them recording into `stats`."""
+        clients = [SimulatedClient(self, namespace, compression)
+                   for _ in xrange(count)]
+        pool = gevent.pool.Pool(concurrency)
+        for client in clients:
+            pool.spawn(client.connect)
+        pool.join(raise_error=True)
+
+        for client in clients:
+            client.greenlet = self.client_greenlets.spawn(client.run, stats)
+        self.clients.extend(clients)
+        return clients
+
+    def disconnect_clients(self, clients):
+        for client in clients:
+            client.close()
+            self.clients.remove(client)
+
+    def wait_for_server_connections(self, count, timeout=30):
+        deadline = time.time() + timeout
+        while len(self.app.connections) != count:
+            if time.time() > deadline:
+                raise Exception(
+                    "expected %d connections on the server, found %d" %
+                    (count, len(self.app.connections)))
+            gevent.sleep(0.01)
+
+    def publish(self, namespace, count, payload_size, rate=None):
+        for _ in xrange(count):
+            self.publisher.publish(namespace, make_payload(payload_size))
+            gevent.sleep(1. / rate if rate else 0)
+
+    def stop(self):
+        self.disconnect_clients(list(self.clients))
+        self.client_greenlets.kill()
+        if self.forwarder:
+            self.forwarder.stop()
+        self.server.stop(timeout=1)
+        if self.app.monitor:
+            self.app.monitor.stop()
+        if isinstance(self.publisher, UnixSocketPublisher):
+            self.publisher.stop()
+            shutil.rmtree(self.directory)
+
+
+class Measurement(object):
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_cpu = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.start_time
+        self.cpu = _cpu_time() - self.start_cpu
+
+
+def _connect_and_measure(harness, args, namespace, stats, compression=False):
+    gc.collect()
+    rss_before = _rss()
+    with Measurement() as connecting:
+        clients = harness.connect_clients(
+            args.clients, namespace, stats, compression=compression)
+        harness.wait_for_server_connections(args.clients)
+    rss_after = _rss()
+
+    return clients, {
+        "clients": args.clients,
+        "connect_seconds": connecting.elapsed,
+        "handshakes_per_sec": args.clients / connecting.elapsed,
+        "rss_bytes": rss_after,
+        "rss_per_conn_bytes": (rss_after - rss_before) / float(args.clients),
+        "cpu_per_conn_us": connecting.cpu / args.clients * 1e6,
+    }
+
+
+def _run_broadcast(harness, args, payload_size, compression):
+    namespace = "/bench/broadcast"
+    stats = DeliveryStats()
+    _, result = _connect_and_measure(
+        harness, args, namespace, stats, compression=compression)
+
+    stats.expected = args.clients * args.messages
+    with Measurement() as broadcasting:
+        harness.publish(namespace, args.messages, payload_size, args.rate)
+        stats.done.wait(timeout=args.timeout)
+
+    result.update(stats.summarize(broadcasting.elapsed))
+    result.update({
+        "messages": args.messages,
+        "payload_bytes": payload_size,
+        "compression": compression,
+        "lost": stats.expected - stats.deliveries,
+        "cpu_seconds": broadcasting.cpu,
+    })
+    return result
+
+
+def scenario_broadcast(harness, args):
+    """Fan a stream of small messages out to every client."""
+    return _run_broadcast(
+        harness, args, payload_size=args.payload_size, compression=False)
+
+
+def scenario_large_payload(harness, args):
+    """Fan large messages out to clients that negotiated compression."""
+    return _run_broadcast(
+        harness, args, payload_size=args.large_payload_size, compression=True)
+
+
+def scenario_hot_churn(harness, args):
+    """Publish to one busy namespace while its subscribers come and go."""
+    namespace = "/bench/hot"
+    stats = DeliveryStats()
+    clients, result = _connect_and_measure(harness, args, namespace, stats)
+    churned = [0]
+
+    def churn():
+        while True:
+            client = random.choice(clients)
+            clients.remove(client)
+            harness.disconnect_clients([client])
+            clients.extend(harness.connect_clients(1, namespace, stats))
+            churned[0] += 1
+            gevent.sleep(1. / args.churn_rate)
+
+    churner = gevent.spawn(churn)
+    with Measurement() as measuring:
+        deadline = time.time() + args.duration
+        while time.time() < deadline:
+            harness.publish(namespace, 1, args.payload_size)
+            gevent.sleep(1. / args.rate if args.rate else 0.001)
+    churner.kill()
+
+    result.update(stats.summarize(measuring.elapsed))
+    result.update({
+        "duration": measuring.elapsed,
+        "reconnects": churned[0],
+        "cpu_seconds": measuring.cpu,
+    })
+    return result
+
+
+def scenario_reconnect_storm(harness, args):
+    """Drop every client at once and have them all reconnect immediately."""
+    namespace = "/bench/storm"
+    stats = DeliveryStats()
+    clients, result = _connect_and_measure(harness, args, namespace, stats)
+
+    with Measurement() as disconnecting:
+        harness.disconnect_clients(clients)
+        harness.wait_for_server_connections(0)
+
+    with Measurement() as reconnecting:
+        harness.connect_clients(args.clients, namespace, stats)
+        harness.wait_for_server_connections(args.clients)
+
+    result.update({
+        "disconnect_seconds": disconnecting.elapsed,
+        "reconnect_seconds": reconnecting.elapsed,
+        "reconnects_per_sec": args.clients / reconnecting.elapsed,
+        "cpu_seconds": disconnecting.cpu + reconnecting.cpu,
+        "reconnect_cpu_per_conn_us":
+            (disconnecting.cpu + reconnecting.cpu) / args.clients * 1e6,
+        "status_messages": getattr(harness.source, "status_messages", None),
+    })
+    return result
+
+
+def scenario_quiesce(harness, args):
+    """Shed every connection the way a quiesced server does."""
+    namespace = "/bench/quiesce"
+    stats = DeliveryStats()
+    _, result = _connect_and_measure(harness, args, namespace, stats)
+
+    # _quiesce() itself waits for deregistration and then exits the process,
+    # so drive the shedding directly.
+    with Measurement() as shedding:
+        harness.app._shed_connections(list(harness.app.connections))
+        harness.wait_for_server_connections(0)
+
+    result.update({
+        "shed_seconds": shedding.elapsed,
+        "closes": stats.closes,
+        "closes_per_sec": stats.closes / shedding.elapsed,
+        "cpu_seconds": shedding.cpu,
+    })
+    return result
+
+
+def _time_handshakes(harness, openssl, mode, seconds):
+    """Have `openssl s_time` hammer the server and count its handshakes."""
+    before = harness.ssl_context.session_stats()
+    with Measurement() as measuring:
+        # -tls1_2 because s_time doesn't wait for TLS 1.3's post-handshake
+        # session tickets, so would never resume.
+        client = gevent.subprocess.Popen(
+            [openssl, "s_time", "-tls1_2", mode, "-time", str(seconds),
+             "-connect", "%s:%d" % harness.address],
+            stdout=gevent.subprocess.PIPE,
+            stderr=gevent.subprocess.STDOUT,
+        )
+        output, _ = client.communicate()
+    after = harness.ssl_context.session_stats()
+
+    if not re.search(r"\d+ connections in", output):
+        raise Exception("openssl s_time failed: %s" % output)
+
+    handshakes = after["accept_good"] - before["accept_good"]
+    resumed = after["hits"] - before["hits"]
+    return {
+        "handshakes": handshakes,
+        "handshakes_per_sec": handshakes / measuring.elapsed,
+        "sessions_resumed": resumed,
+        "cpu_per_handshake_us": measuring.cpu / max(handshakes, 1) * 1e6,
+    }
+
+
+def scenario_tls_resumption(harness, args):
+    """Compare full TLS handshakes with resumed ones."""
+    openssl = find_executable("openssl")
+    if not openssl:
+        return {"skipped": "openssl not found"}
+
+    result = {}
+    for mode in ("new", "reuse"):
+        stats = _time_handshakes(
+            harness, openssl, "-" + mode, args.handshake_seconds)
+        for key, value in stats.items():
+            result["%s_%s" % (mode, key)] = value
+    return result
+
+
+SCENARIOS = {
+    "broadcast": scenario_broadcast,
+    "hot_churn": scenario_hot_churn,
+    "reconnect_storm": scenario_reconnect_storm,
+    "large_payload": scenario_large_payload,
+    "quiesce": scenario_quiesce,
+    "tls_resumption": scenario_tls_resumption,
+}
+
+# scenarios that only make sense with something terminating TLS
+TLS_SCENARIOS = {"tls_resumption"}
+
+
+def run_scenario(name, args):
+    tls = args.tls
+    if not tls and name in TLS_SCENARIOS:
+        tls = "native"
+    harness = Harness(source=args.source, tls=tls, app_config=args.app_config)
+    try:
+        result = SCENARIOS[name](harness, args)
+    finally:
+        harness.stop()
+    result["scenario"] = name
+    result["source"] = args.source
+    result["tls"] = tls
+    return result
+
+
+def compare(before_path, after_path, output):
+    """Print the relative change in each numeric result between two runs."""
+    def load(path):
+        with open(path) as results_file:
+            return {result["scenario"]: result
+                    for result in map(json.loads, results_file)}
+
+    before = load(before_path)
+    after = load(after_path)
+    for scenario in sorted(set(before) & set(after)):
+        for key in sorted(before[scenario]):
+            old = before[scenario][key]
+            new = after[scenario].get(key)
+            if isinstance(old, bool) or not isinstance(old, (int, float)):
+                continue
+            if not isinstance(new, (int, float)):
+                continue
+            change = (new - old) / float(old) * 100 if old else 0.
+            output.write("%-16s %-22s %14.3f %14.3f %+8.1f%%\n" % (
+                scenario, key, old, new, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help="scenarios to run (default: all of them): %s" %
+                        ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100,
+                        help="messages published per broadcast scenario")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages published per second (0: unthrottled)")
+    parser.add_argument("--payload-size", type=int, default=128)
+    parser.add_argument("--large-payload-size", type=int, default=16384)
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to run the churn scenario for")
+    parser.add_argument("--churn-rate", type=float, default=100,
+                        help="reconnects per second in the churn scenario")
+    parser.add_argument("--source", choices=["fake", "unix"], default="fake",
+                        help="feed messages in directly or through the unix "
+                        "socket message source")
+    parser.add_argument("--set", dest="app_config", action="append",
+                        default=[], metavar="KEY=VALUE",
+                        help="override an app config option, e.g. "
+                        "monitor.enabled=false (may be repeated)")
+    parser.add_argument("--tls", choices=["native", "proxied"],
+                        help="terminate TLS in the server, or in a "
+                        "forwarder in front of it (default: plain HTTP)")
+    parser.add_argument("--handshake-seconds", type=int, default=5,
+                        help="seconds to time each kind of TLS handshake for")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds to wait for every delivery")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare the results of two earlier runs")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare[0], args.compare[1], sys.stdout)
+        return
+
+    try:
+        args.app_config = dict(option.split("=", 1)
+                               for option in args.app_config)
+    except ValueError:
+        parser.error("--set takes KEY=VALUE")
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+    _raise_fd_limit()
+    for name in args.scenarios or sorted(SCENARIOS):
+        result = run_scenario(name, args)
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
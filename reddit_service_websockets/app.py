@@ -10,15 +10,49 @@ from baseplate import (
 )
 from baseplate.secrets import secrets_store_from_config
 
-from .dispatcher import MessageDispatcher
+from .dispatcher import (
+    MessageDispatcher,
+    NAMESPACE_CACHE_SIZE,
+    parse_coalesce_rules,
+)
+from .monitor import HubMonitor
 from .socketserver import SocketServer
 from .source import MessageSource
+from .unix_source import UnixSocketMessageSource
 
 
 manhole.install(oneshot_on='USR1')
 
 
 CONFIG_SPEC = {
+    "source": {
+        "backend": config.Optional(
+            config.OneOf(amqp="amqp", unix="unix"), default="amqp"),
+    },
+
+    "dispatch": {
+        "coalesce": config.Optional(config.TupleOf(config.String), default=[]),
+        "binary": config.Optional(config.TupleOf(config.String), default=[]),
+        "namespace_cache_size": config.Optional(
+            config.Integer, default=NAMESPACE_CACHE_SIZE),
+    },
+
+    "web": {
+        "ping_interval": config.Integer,
+        "admin_auth": config.String,
+        "conn_shed_rate": config.Integer,
+    },
+
+    "monitor": {
+        "enabled": config.Optional(config.Boolean, default=True),
+        "stall_threshold_ms": config.Optional(config.Integer, default=100),
+    },
+}
+
+
+# configuration for each message source backend. only the one selected by
+# source.backend is required.
+SOURCE_CONFIG_SPECS = {
     "amqp": {
         "endpoint": config.Endpoint,
         "vhost": config.String,
@@ -31,29 +65,59 @@ CONFIG_SPEC = {
         },
 
         "send_status_messages": config.Boolean,
+
+        "fallback_endpoints": config.Optional(
+            config.TupleOf(config.Endpoint), default=[]),
+        "reconnect_delay": {
+            "min": config.Optional(config.Float, default=0.1),
+            "max": config.Optional(config.Float, default=30.),
+        },
+        "queue_ttl": config.Optional(config.Integer, default=0),
+        "status_buffer_size": config.Optional(config.Integer, default=1000),
     },
 
-    "web": {
-        "ping_interval": config.Integer,
-        "admin_auth": config.String,
-        "conn_shed_rate": config.Integer,
+    "unix": {
+        "directory": config.String,
+        "mode": config.Optional(config.Integer(base=8), default=0o660),
     },
 }
 
 
-def make_app(raw_config):
+SOURCE_BACKENDS = {
+    "amqp": MessageSource,
+    "unix": UnixSocketMessageSource,
+}
+
+
+def make_source(raw_config, backend, metrics):
+    cfg = config.parse_config(
+        raw_config, {backend: SOURCE_CONFIG_SPECS[backend]})
+    return SOURCE_BACKENDS[backend](config=cfg[backend], metrics=metrics)
+
+
+def make_app(raw_config, source=None):
+    """Make the websocket app.
+
+    `source` replaces the message source selected by `source.backend`, which
+    lets the benchmarks run the real app fed by a fake source.
+
+    """
     cfg = config.parse_config(raw_config, CONFIG_SPEC)
 
     metrics_client = metrics_client_from_config(raw_config)
     error_reporter = error_reporter_from_config(raw_config, __name__)
     secrets = secrets_store_from_config(raw_config)
 
-    dispatcher = MessageDispatcher(metrics=metrics_client)
-
-    source = MessageSource(
-        config=cfg.amqp,
+    dispatcher = MessageDispatcher(
+        metrics=metrics_client,
+        coalesce_rules=parse_coalesce_rules(cfg.dispatch.coalesce),
+        binary_namespaces=cfg.dispatch.binary,
+        namespace_cache_size=cfg.dispatch.namespace_cache_size,
     )
 
+    if source is None:
+        source = make_source(raw_config, cfg.source.backend, metrics_client)
+
     app = SocketServer(
         metrics=metrics_client,
         dispatcher=dispatcher,
@@ -73,8 +137,17 @@ def make_app(raw_config):
     signal.signal(signal.SIGUSR2, _handle_quiesce_signal)
     signal.siginterrupt(signal.SIGUSR2, False)
 
+    if cfg.monitor.enabled:
+        monitor = HubMonitor(
+            metrics=metrics_client,
+            stall_threshold=cfg.monitor.stall_threshold_ms / 1000.,
+        )
+        monitor.start()
+        app.monitor = monitor
+
     source.message_handler = dispatcher.on_message_received
     app.status_publisher = source.send_message
+    app.message_source = source
 
     gevent.spawn(source.pump_messages)
 
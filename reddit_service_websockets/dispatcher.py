@@ -1,4 +1,5 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+import json
 import posixpath
 import random
 from zlib import (
@@ -29,7 +30,51 @@ COMPRESSOR = compressobj(7, DEFLATED, -MAX_WBITS)
 MIN_COMPRESS_SIZE = 1500
 
 
-Message = namedtuple('Message', ['compressed', 'raw'])
+# how many namespaces nobody is listening to we'll remember the ancestors of
+NAMESPACE_CACHE_SIZE = 10000
+
+
+# `raw` is always a byte string; text messages are utf-8 encoded once here
+# rather than by every websocket they're sent to. for enveloped listeners,
+# `raw` (and `compressed`) start with the namespace and a newline.
+Message = namedtuple('Message', ['namespace', 'compressed', 'raw', 'binary'])
+
+
+CoalesceRule = namedtuple('CoalesceRule', ['window', 'key'])
+
+
+def parse_coalesce_rules(specs):
+    """Parse coalescing configuration into a dict of rules by namespace.
+
+    Each spec looks like `namespace:milliseconds` or
+    `namespace:milliseconds:key`. The rule applies to messages sent to the
+    namespace and any namespace beneath it; if a key is given, messages are
+    coalesced separately for each value of that field in their JSON payload.
+
+    """
+    rules = {}
+    for spec in specs:
+        parts = spec.split(":")
+        if len(parts) not in (2, 3) or not parts[0].startswith("/"):
+            raise ValueError("invalid coalesce rule: %r" % spec)
+
+        namespace = parts[0].rstrip("/") or "/"
+        window = int(parts[1]) / 1000.
+        key = parts[2] if len(parts) == 3 else None
+        rules[namespace] = CoalesceRule(window=window, key=key)
+    return rules
+
+
+def _get_coalesce_key(message, field):
+    if field is None:
+        return None
+
+    try:
+        value = json.loads(message).get(field)
+        hash(value)
+    except (ValueError, AttributeError, TypeError):
+        return None
+    return value
 
 
 def _walk_namespace_hierarchy(namespace):
@@ -41,27 +86,365 @@ def _walk_namespace_hierarchy(namespace):
         yield namespace
 
 
+def _namespace_ancestors(namespace):
+    # routing keys can be anything. ones that aren't paths (or that have a
+    # newline, which would garble envelopes) have no ancestors and nobody can
+    # subscribe to them.
+    if not namespace.startswith("/") or "\n" in namespace:
+        return (namespace,)
+    return tuple(_walk_namespace_hierarchy(namespace))
+
+
+def _encode_envelope(namespace, payload):
+    if isinstance(namespace, unicode):
+        namespace = namespace.encode("utf-8")
+    return namespace + "\n" + payload
+
+
+def _intern(name):
+    # only byte strings can be interned in python 2
+    if type(name) is str:
+        return intern(name)
+    return name
+
+
+class _Namespace(object):
+    """Everything the dispatcher knows about a single namespace.
+
+    There can be a great many of these, so they're slotted and don't grow
+    sets of listeners until somebody actually listens.
+
+    """
+
+    __slots__ = (
+        "name",
+        "ancestors",
+        "refcount",
+        "listeners",
+        "wildcard_listeners",
+    )
+
+    def __init__(self, name, ancestors):
+        self.name = name
+        self.ancestors = ancestors
+        self.refcount = 0
+        self.listeners = None
+        self.wildcard_listeners = None
+
+
+class _NamespaceTable(object):
+    """Interned namespaces and their precomputed ancestor chains.
+
+    Namespaces with listeners are reference counted and kept for as long as
+    they're in use. Once their last listener leaves they're kept in a bounded
+    LRU so that connection churn doesn't have to recompute them, without
+    memory growing forever. Incoming messages only ever read from the table.
+
+    """
+
+    def __init__(self, max_unused):
+        self.max_unused = max_unused
+        self.entries = {}
+        self.unused = OrderedDict()
+
+    def get(self, name):
+        """Return the entry for a namespace, or None if we don't have one."""
+        return self.entries.get(name)
+
+    def _lookup(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            name = _intern(name)
+            ancestors = tuple(_intern(ns) for ns in _namespace_ancestors(name))
+            entry = self.entries[name] = _Namespace(name, ancestors)
+        return entry
+
+    def _mark_unused(self, entry):
+        self.unused[entry.name] = entry
+        while len(self.unused) > self.max_unused:
+            name, _ = self.unused.popitem(last=False)
+            del self.entries[name]
+
+    def ancestors(self, name):
+        """Return a tuple of the namespace followed by each of its ancestors."""
+        entry = self._lookup(name)
+        if not entry.refcount:
+            self.unused.pop(entry.name, None)
+            self._mark_unused(entry)
+        return entry.ancestors
+
+    def peek_ancestors(self, name):
+        """Like `ancestors`, but never adds to or reorders the table.
+
+        This is for the message path, so that routing keys nobody listens to
+        can't push the entries worth keeping out of the LRU.
+
+        """
+        entry = self.entries.get(name)
+        if entry is not None:
+            return entry.ancestors
+        return _namespace_ancestors(name)
+
+    def acquire(self, name):
+        entry = self._lookup(name)
+        if not entry.refcount:
+            self.unused.pop(entry.name, None)
+        entry.refcount += 1
+        return entry
+
+    def release(self, entry):
+        entry.refcount -= 1
+        if not entry.refcount:
+            self._mark_unused(entry)
+
+
+def _namespace_prefix(namespace):
+    """Return the top-level component of a namespace, e.g. /live for /live/x."""
+    return "/" + namespace.split("/", 2)[1]
+
+
 class MessageDispatcher(object):
-    def __init__(self, metrics):
-        self.consumers = {}
+    def __init__(self, metrics, coalesce_rules=None, binary_namespaces=(),
+                 namespace_cache_size=NAMESPACE_CACHE_SIZE):
+        self.namespaces = _NamespaceTable(max_unused=namespace_cache_size)
+        self.wildcard_subscriptions = 0
         self.metrics = metrics
 
-    def on_message_received(self, namespace, message):
-        consumers = self.consumers.get(namespace, [])
+        # while a coalescing window is open for a (namespace, key), this holds
+        # the newest message that arrived during it, or None if there's been
+        # nothing since the window opened.
+        self.coalesce_rules = coalesce_rules or {}
+        self.coalescing = {}
+
+        # messages to these namespaces (and everything beneath them) always
+        # go out in BINARY frames, whatever the source said they were.
+        self.binary_namespaces = frozenset(
+            ns.rstrip("/") or "/" for ns in binary_namespaces)
+
+        # these are kept up to date as things happen so that reporting stats
+        # doesn't have to walk every connection.
+        self.listeners_by_prefix = defaultdict(int)
 
-        # Compress the message
-        if len(message) >= MIN_COMPRESS_SIZE:
-            compressed = make_compressed_frame(message, COMPRESSOR)
+        # queues of listeners that want each message tagged with its namespace
+        self.enveloped_listeners = set()
+
+        self.queued_messages = 0
+        self.queued_bytes = 0
+        self.messages_received = 0
+        self.messages_compressed = 0
+        self.messages_coalesced = 0
+
+    def _find_consumers(self, namespace):
+        entry = self.namespaces.get(namespace)
+        if entry is not None and entry.listeners:
+            consumers = entry.listeners
+        else:
+            consumers = ()
+
+        if not self.wildcard_subscriptions:
+            return consumers
+
+        # wildcards are indexed by prefix, so this costs one lookup per level
+        # of the namespace no matter how many subscriptions are out there.
+        matches = []
+        for ns in self.namespaces.peek_ancestors(namespace):
+            ancestor = self.namespaces.get(ns)
+            if ancestor is not None and ancestor.wildcard_listeners:
+                matches.append(ancestor.wildcard_listeners)
+        if not matches:
+            return consumers
+
+        # a listener can match both directly and through a wildcard (or
+        # through several wildcards) but should only get the message once.
+        return set(consumers).union(*matches)
+
+    def _find_coalesce_rule(self, namespace):
+        for ns in self.namespaces.peek_ancestors(namespace):
+            rule = self.coalesce_rules.get(ns)
+            if rule:
+                return rule
+        return None
+
+    def _is_binary_namespace(self, namespace):
+        for ns in self.namespaces.peek_ancestors(namespace):
+            if ns in self.binary_namespaces:
+                return True
+        return False
+
+    def on_message_received(self, namespace, message, binary=False):
+        """Send a message to everyone listening to the namespace.
+
+        Text messages are unicode (or utf-8 encoded) strings and go out in
+        TEXT frames. If `binary` is set, the message is a byte string that's
+        passed through untouched in a BINARY frame.
+
+        """
+        self.messages_received += 1
+
+        if not binary and self.binary_namespaces:
+            if self._is_binary_namespace(namespace):
+                if isinstance(message, unicode):
+                    message = message.encode("utf-8")
+                binary = True
+
+        if self.coalesce_rules:
+            rule = self._find_coalesce_rule(namespace)
+            if rule:
+                self._coalesce(namespace, message, binary, rule)
+                return
+
+        self._dispatch(namespace, message, binary)
+
+    def _coalesce(self, namespace, message, binary, rule):
+        """Throttle a namespace to one message per window.
+
+        The first message goes out right away and opens a window. Anything
+        arriving while the window is open replaces whatever was waiting, and
+        the newest is sent when the window closes (opening another). Only
+        the latest value of a fast-changing thing like a vote count matters,
+        so the intermediate messages are never compressed, framed or written.
+
+        """
+        if binary:
+            # there's no telling what's in a binary payload, so coalesce them
+            # all together rather than picking a key out of them.
+            key = (namespace, None)
+        else:
+            key = (namespace, _get_coalesce_key(message, rule.key))
+
+        if key in self.coalescing:
+            if self.coalescing[key] is not None:
+                self.messages_coalesced += 1
+                self.metrics.counter("dispatch.coalesced").increment()
+            self.coalescing[key] = (message, binary)
+            return
+
+        self.coalescing[key] = None
+        self._dispatch(namespace, message, binary)
+        gevent.spawn_later(rule.window, self._close_coalesce_window, key, rule)
+
+    def _close_coalesce_window(self, key, rule):
+        pending = self.coalescing[key]
+        if pending is None:
+            del self.coalescing[key]
+            return
+
+        self.coalescing[key] = None
+        message, binary = pending
+        self._dispatch(key[0], message, binary)
+        gevent.spawn_later(rule.window, self._close_coalesce_window, key, rule)
+
+    def _make_message(self, namespace, payload, binary):
+        if len(payload) >= MIN_COMPRESS_SIZE:
+            compressed = make_compressed_frame(
+                payload, COMPRESSOR, binary=binary)
+            self.messages_compressed += 1
         else:
             compressed = None
-        message = Message(compressed=compressed, raw=message)
+        return Message(namespace=namespace, compressed=compressed,
+                       raw=payload, binary=binary)
+
+    def _dispatch(self, namespace, message, binary=False):
+        consumers = self._find_consumers(namespace)
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        plain = self._make_message(namespace, message, binary)
+
+        # the enveloped version is only built (and compressed) if somebody
+        # listening to this namespace asked for it.
+        enveloped = None
 
         with self.metrics.timer("dispatch"):
             for consumer in consumers:
-                consumer.put(message)
+                if consumer in self.enveloped_listeners:
+                    if enveloped is None:
+                        enveloped = self._make_message(
+                            namespace, _encode_envelope(namespace, message),
+                            binary)
+                    message_for_consumer = enveloped
+                else:
+                    message_for_consumer = plain
+
+                self.queued_messages += 1
+                self.queued_bytes += len(message_for_consumer.raw)
+                consumer.put(message_for_consumer)
 
-    def listen(self, namespace, max_timeout):
-        """Register to listen to a namespace and yield messages as they arrive.
+    def get_stats(self):
+        return {
+            "listeners_by_prefix": dict(self.listeners_by_prefix),
+            "queued_messages": self.queued_messages,
+            "queued_bytes": self.queued_bytes,
+            "messages_received": self.messages_received,
+            "messages_compressed": self.messages_compressed,
+            "messages_coalesced": self.messages_coalesced,
+            "namespaces": len(self.namespaces.entries) - len(self.namespaces.unused),
+            "namespaces_cached": len(self.namespaces.unused),
+        }
+
+    def _on_message_dequeued(self, message):
+        self.queued_messages -= 1
+        self.queued_bytes -= len(message.raw)
+
+    def _parse_subscriptions(self, namespaces):
+        """Work out where to register a listener for a list of namespaces.
+
+        Returns the normalized namespaces, the set of namespaces to register
+        in directly (each namespace and its ancestors) and the set of
+        wildcard prefixes. A namespace ending in `/*` is a wildcard matching
+        itself and every namespace beneath it.
+
+        """
+        subscribed = set()
+        exact = set()
+        wildcards = set()
+        for namespace in namespaces:
+            if namespace.endswith("/*"):
+                namespace = namespace[:-2] or "/"
+                wildcards.add(namespace)
+            namespace = namespace.rstrip("/") or "/"
+            subscribed.add(namespace)
+            exact.update(self.namespaces.ancestors(namespace))
+        return subscribed, exact, wildcards
+
+    def _subscribe(self, namespace, queue):
+        entry = self.namespaces.acquire(namespace)
+        if entry.listeners is None:
+            entry.listeners = set()
+        entry.listeners.add(queue)
+        return entry
+
+    def _unsubscribe(self, entry, queue):
+        entry.listeners.discard(queue)
+        if not entry.listeners:
+            entry.listeners = None
+        self.namespaces.release(entry)
+
+    def _subscribe_wildcard(self, namespace, queue):
+        entry = self.namespaces.acquire(namespace)
+        if entry.wildcard_listeners is None:
+            entry.wildcard_listeners = set()
+        entry.wildcard_listeners.add(queue)
+        self.wildcard_subscriptions += 1
+        return entry
+
+    def _unsubscribe_wildcard(self, entry, queue):
+        entry.wildcard_listeners.discard(queue)
+        if not entry.wildcard_listeners:
+            entry.wildcard_listeners = None
+        self.wildcard_subscriptions -= 1
+        self.namespaces.release(entry)
+
+    def listen(self, namespaces, max_timeout, envelope=False):
+        """Register to listen to namespaces and yield messages as they arrive.
+
+        `namespaces` is a list of namespaces to listen to. Messages sent to
+        any of them, or to any of their ancestors, are yielded (once each). A
+        namespace ending in `/*`, e.g. `/live/*`, is a wildcard which also
+        matches every namespace beneath it.
+
+        If `envelope` is set, each message's payload is prefixed with the
+        namespace it was sent to and a newline, so that a listener with
+        several namespaces can tell which one a message belongs to.
 
         If no messages arrive within `max_timeout` seconds, this will yield a
         `None` to allow clients to do periodic actions like send PINGs.
@@ -71,10 +454,17 @@ class MessageDispatcher(object):
 
         """
         queue = gevent.queue.Queue()
+        if envelope:
+            self.enveloped_listeners.add(queue)
+
+        subscribed, exact, wildcards = self._parse_subscriptions(namespaces)
+        entries = [self._subscribe(ns, queue) for ns in exact]
+        wildcard_entries = [self._subscribe_wildcard(ns, queue)
+                            for ns in wildcards]
 
-        namespace = namespace.rstrip("/")
-        for ns in _walk_namespace_hierarchy(namespace):
-            self.consumers.setdefault(ns, []).append(queue)
+        prefixes = set(_namespace_prefix(ns) for ns in subscribed)
+        for prefix in prefixes:
+            self.listeners_by_prefix[prefix] += 1
 
         try:
             while True:
@@ -82,14 +472,26 @@ class MessageDispatcher(object):
                 timeout = max_timeout - random.uniform(0, max_timeout / 2)
 
                 try:
-                    yield queue.get(block=True, timeout=timeout)
+                    message = queue.get(block=True, timeout=timeout)
                 except gevent.queue.Empty:
                     yield None
+                else:
+                    self._on_message_dequeued(message)
+                    yield message
 
                 # ensure we're not starving others by spinning
                 gevent.sleep()
         finally:
-            for ns in _walk_namespace_hierarchy(namespace):
-                self.consumers[ns].remove(queue)
-                if not self.consumers[ns]:
-                    del self.consumers[ns]
+            for entry in entries:
+                self._unsubscribe(entry, queue)
+            for entry in wildcard_entries:
+                self._unsubscribe_wildcard(entry, queue)
+            self.enveloped_listeners.discard(queue)
+
+            for prefix in prefixes:
+                self.listeners_by_prefix[prefix] -= 1
+                if not self.listeners_by_prefix[prefix]:
+                    del self.listeners_by_prefix[prefix]
+
+            for message in queue.queue:
+                self._on_message_dequeued(message)
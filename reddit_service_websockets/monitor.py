@@ -0,0 +1,219 @@
+"""Event loop stall detection and sampled profiling.
+
+Everything in this service shares a single gevent hub, so any greenlet that
+runs for a long time without yielding (a huge compression, a disconnect storm
+pruning consumer lists, JSON encoding a big status message) delays every
+other socket on the process.  The `HubMonitor` watches greenlet switches to
+spot these stalls and can take a short statistical CPU profile on demand.
+
+"""
+from collections import defaultdict, deque, namedtuple
+import linecache
+import logging
+import signal
+import time
+import traceback
+
+import gevent
+import gevent.hub
+import greenlet
+
+
+LOG = logging.getLogger(__name__)
+
+
+# the deepest stack we'll walk when sampling; deeper frames are truncated
+MAX_SAMPLE_DEPTH = 64
+
+
+Stall = namedtuple("Stall", ["timestamp", "duration", "greenlet", "stack"])
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+def _describe_greenlet(glet, run):
+    """Return a short, stable label for what a greenlet is running."""
+    if run is None:
+        return type(glet).__name__
+    return getattr(run, "__name__", type(run).__name__)
+
+
+def _describe_frame(frame):
+    code = frame.f_code
+    return "%s:%s:%d" % (code.co_filename, code.co_name, frame.f_lineno)
+
+
+def _extract_stack(frame):
+    """Return the stack above `frame`, root first, without any source."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _format_stack(stack):
+    return "".join(traceback.format_list([
+        (filename, lineno, name, linecache.getline(filename, lineno).strip())
+        for filename, lineno, name in stack
+    ]))
+
+
+class HubMonitor(object):
+    """Track how long each greenlet runs between switches.
+
+    A greenlet trace function timestamps every switch.  When a greenlet other
+    than the hub itself ran for longer than `stall_threshold` seconds before
+    yielding, the stall is logged, counted and kept (with the stack the
+    greenlet yielded from) in a small ring buffer for later inspection.  The
+    trace function only does a clock read and a subtraction on the fast path,
+    so it is cheap enough to leave on in production.
+
+    The trace function runs in the middle of a switch, so it mustn't do
+    anything that could switch again.  It only notes the stall down, and the
+    logging and metrics happen in a callback on the event loop afterwards.
+
+    `profile` additionally samples the running stack on a CPU timer for a
+    fixed period and attributes run time to greenlets.
+
+    """
+
+    def __init__(self, metrics, stall_threshold, max_stalls=100):
+        self.metrics = metrics
+        self.stall_threshold = stall_threshold
+        self.stalls = deque(maxlen=max_stalls)
+
+        # stalls noted by the trace function but not yet reported
+        self._unreported_stalls = deque(maxlen=max_stalls)
+        self._report_scheduled = False
+
+        self._last_switch = time.time()
+        self._current_run = None
+        self._previous_tracer = None
+        self._greenlet_times = None
+        self._stack_samples = None
+
+    def start(self):
+        self._last_switch = time.time()
+        self._previous_tracer = greenlet.settrace(self._on_switch)
+
+    def stop(self):
+        greenlet.settrace(self._previous_tracer)
+        self._previous_tracer = None
+
+    def _on_switch(self, event, args):
+        if event in ("switch", "throw"):
+            origin, target = args
+            now = time.time()
+            elapsed = now - self._last_switch
+            self._last_switch = now
+
+            # time spent in the hub is mostly spent waiting on the event loop
+            # for something to do, so it isn't interesting here.
+            if not isinstance(origin, gevent.hub.Hub):
+                if self._greenlet_times is not None:
+                    description = _describe_greenlet(origin, self._current_run)
+                    self._greenlet_times[description] += elapsed
+
+                if self.stall_threshold and elapsed >= self.stall_threshold:
+                    self._record_stall(origin, elapsed)
+
+            # gevent forgets what a greenlet was running once it finishes, so
+            # hold on to it while it's switched in for use in descriptions.
+            self._current_run = getattr(target, "_run", None)
+
+        if self._previous_tracer:
+            self._previous_tracer(event, args)
+
+    def _record_stall(self, glet, elapsed):
+        self._unreported_stalls.append((
+            time.time(),
+            elapsed,
+            _describe_greenlet(glet, self._current_run),
+            _extract_stack(glet.gr_frame),
+        ))
+
+        if not self._report_scheduled:
+            self._report_scheduled = True
+            gevent.get_hub().loop.run_callback(self._report_stalls)
+
+    def _report_stalls(self):
+        self._report_scheduled = False
+        while self._unreported_stalls:
+            timestamp, elapsed, description, stack = (
+                self._unreported_stalls.popleft())
+            stack = _format_stack(stack)
+
+            self.stalls.append(Stall(
+                timestamp=timestamp,
+                duration=elapsed,
+                greenlet=description,
+                stack=stack,
+            ))
+            self.metrics.counter("hub.stall").increment()
+            self.metrics.timer("hub.stall").send(elapsed)
+            LOG.warning("hub stalled for %.3fs by %s:\n%s",
+                        elapsed, description, stack)
+
+    def _on_sample(self, signum, frame):
+        # a signal that arrived just as a profile ended can still be
+        # delivered after it's over.
+        if self._stack_samples is None:
+            return
+
+        stack = []
+        while frame is not None and len(stack) < MAX_SAMPLE_DEPTH:
+            stack.append(_describe_frame(frame))
+            frame = frame.f_back
+        stack.append(
+            _describe_greenlet(greenlet.getcurrent(), self._current_run))
+        stack.reverse()
+        self._stack_samples[";".join(stack)] += 1
+
+    def profile(self, duration, interval=0.005):
+        """Profile the process for `duration` seconds and return the results.
+
+        Stacks are sampled every `interval` seconds of CPU time and returned
+        in "folded" form (frames joined by `;`, root first) with their sample
+        counts, ready to be fed to flamegraph tools.  Wall time spent running
+        each kind of greenlet and the most recent stalls are reported
+        alongside.
+
+        This blocks the calling greenlet, but not the hub, for `duration`.
+        Only one profile may run at a time.
+
+        """
+        if self._stack_samples is not None:
+            raise ProfilerBusyError
+
+        self._greenlet_times = defaultdict(float)
+        self._stack_samples = defaultdict(int)
+
+        # the handler is left installed afterwards since a SIGPROF that's
+        # already pending when the timer stops would otherwise go to the
+        # default handler, which kills the process.
+        signal.signal(signal.SIGPROF, self._on_sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        try:
+            gevent.sleep(duration)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+            stacks = self._stack_samples
+            greenlet_times = self._greenlet_times
+            self._stack_samples = None
+            self._greenlet_times = None
+
+        return {
+            "duration": duration,
+            "interval": interval,
+            "samples": sum(stacks.itervalues()),
+            "stacks": dict(stacks),
+            "greenlets": dict(greenlet_times),
+            "stalls": [stall._asdict() for stall in self.stalls],
+        }
@@ -14,6 +14,7 @@ from geventwebsocket.exceptions import (
     WebSocketError,
 )
 from geventwebsocket.websocket import (
+    MSG_ALREADY_CLOSED,
     MSG_SOCKET_DEAD,
     Header,
     WebSocket,
@@ -33,7 +34,7 @@ def _encode_bytes(text):
     return text.encode('utf-8')
 
 
-def make_compressed_frame(message, compressor):
+def make_compressed_frame(message, compressor, binary=None):
     """
     Make a compressed websocket frame from a message and compressor.
 
@@ -42,9 +43,11 @@ def make_compressed_frame(message, compressor):
     This prevents the need to re-compress a broadcast-style message for every
     websocket connection.
 
-    `compressor` is a zlib compressor object.
+    `compressor` is a zlib compressor object.  If `binary` is not given, the
+    opcode is guessed from the type of `message`.
     """
-    binary = not isinstance(message, (str, unicode))
+    if binary is None:
+        binary = not isinstance(message, (str, unicode))
     opcode = WebSocket.OPCODE_BINARY if binary else WebSocket.OPCODE_TEXT
     if binary:
         message = str(message)
@@ -79,6 +82,24 @@ def send_raw_frame(websocket, raw_message):
         raise WebSocketError(MSG_SOCKET_DEAD)
 
 
+def send_encoded_frame(websocket, message, binary=False):
+    """
+    Send an uncompressed frame whose payload is already a byte string.
+
+    Unlike `WebSocket.send`, this doesn't re-encode text messages (which it
+    can't do for utf-8 byte strings anyway), so a broadcast is encoded once
+    rather than once per websocket.
+    """
+    if websocket.closed:
+        websocket.current_app.on_close(MSG_ALREADY_CLOSED)
+        raise WebSocketError(MSG_ALREADY_CLOSED)
+
+    opcode = WebSocket.OPCODE_BINARY if binary else WebSocket.OPCODE_TEXT
+    header = Header.encode_header(
+        fin=True, opcode=opcode, mask='', length=len(message), flags=0)
+    send_raw_frame(websocket, header + message)
+
+
 def read_frame(websocket):
     # Patched `read_frame` method that supports decompression
 
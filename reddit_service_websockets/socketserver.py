@@ -1,3 +1,4 @@
+import json
 import logging
 import sys
 import urlparse
@@ -10,13 +11,22 @@ from geventwebsocket.websocket import WebSocket
 from baseplate.crypto import validate_signature, SignatureError
 from raven.utils.wsgi import get_current_url, get_headers, get_environ
 
+from .monitor import ProfilerBusyError
 from .patched_websocket import read_frame as patched_read_frame
-from .patched_websocket import send_raw_frame
+from .patched_websocket import send_encoded_frame, send_raw_frame
+from .stats import format_prometheus, PROMETHEUS_CONTENT_TYPE
 
 
 LOG = logging.getLogger(__name__)
 
 
+# the longest profile an admin may request in one go, in seconds
+MAX_PROFILE_DURATION = 60
+
+# the most namespaces a single socket may listen to
+MAX_NAMESPACES = 100
+
+
 WebSocket.read_frame = patched_read_frame
 
 
@@ -75,20 +85,37 @@ class WebSocketHandler(geventwebsocket.handler.WebSocketHandler):
         self.environ["supports_compression"] = \
             "permessage-deflate" in extensions
 
+        # A socket listens to the namespace in its path and optionally to more
+        # given as `ns` parameters (any of which may be a wildcard like
+        # `/live/*`). The signature covers all of them, joined by newlines in
+        # the order given, so a plain single-namespace socket is signed just
+        # as it always was.
         try:
             namespace = self.environ["PATH_INFO"]
             query_string = self.environ["QUERY_STRING"]
             params = urlparse.parse_qs(query_string, strict_parsing=True)
             signature = params["m"][0]
+            namespaces = [namespace] + params.get("ns", [])
+            if len(namespaces) > MAX_NAMESPACES:
+                raise ValueError("too many namespaces")
+            for ns in namespaces:
+                # newlines would make the signed string ambiguous
+                if not ns.startswith("/") or "\n" in ns:
+                    raise ValueError("invalid namespace")
 
             secret = app.secrets.get_versioned("secret/websockets/authorization_key")
-            validate_signature(secret, namespace, signature)
+            validate_signature(secret, "\n".join(namespaces), signature)
         except (KeyError, IndexError, ValueError, SignatureError):
             app.metrics.counter("conn.rejected.bad_namespace").increment()
             self.start_response("403 Forbidden", [])
             return ["Forbidden"]
 
         self.environ["signature_validated"] = True
+        self.environ["websocket.namespaces"] = namespaces
+        # clients listening to several namespaces can ask for each message to
+        # be prefixed with the one it was sent to. it doesn't change what the
+        # socket can see, so it isn't signed.
+        self.environ["websocket.envelope"] = params.get("envelope") == ["1"]
 
         return super(WebSocketHandler, self).upgrade_connection()
 
@@ -130,8 +157,12 @@ class SocketServer(object):
         self.admin_auth = admin_auth
         self.shed_rate_per_sec = conn_shed_rate
         self.status_publisher = None
+        self.message_source = None
+        self.monitor = None
+        self.ssl_context = None
         self.quiesced = False
         self.connections = set()
+        self.compressed_connections = 0
 
     def __call__(self, environ, start_response):
         try:
@@ -155,6 +186,12 @@ class SocketServer(object):
         path_info = environ["PATH_INFO"]
         req_method = environ['REQUEST_METHOD']
 
+        # stats stay available while quiesced so that we can keep an eye on
+        # the connections draining. they give away namespaces and broker
+        # state, so they're admin-only.
+        if path_info == "/stats" and req_method == "GET":
+            return self._stats(environ, start_response)
+
         if self.quiesced:
             start_response("410 Gone", [])
             return ['{"status": "quiesced", "connections": %d}' %
@@ -171,6 +208,9 @@ class SocketServer(object):
                 start_response("401 Unauthorized", [])
                 return ["invalid authentication"]
 
+        if path_info == '/profile' and req_method == 'GET':
+            return self._profile(environ, start_response)
+
         if path_info == "/health":
             start_response("200 OK", [
                 ("Content-Type", "application/json"),
@@ -188,16 +228,20 @@ class SocketServer(object):
         # handler subclass which validates namespace signatures
         assert environ["signature_validated"]
 
-        namespace = environ["PATH_INFO"]
+        namespaces = environ["websocket.namespaces"]
 
         dispatcher = gevent.spawn(
-            self._pump_dispatcher, namespace, websocket,
-            supports_compression=environ.get("supports_compression"))
+            self._pump_dispatcher, namespaces, websocket,
+            supports_compression=environ.get("supports_compression"),
+            envelope=environ.get("websocket.envelope", False))
         self.connections.add(websocket)
+        if environ.get("supports_compression"):
+            self.compressed_connections += 1
 
         try:
             self.metrics.counter("conn.connected").increment()
-            self._send_message("connect", {"namespace": namespace})
+            for namespace in namespaces:
+                self._send_message("connect", {"namespace": namespace})
             while True:
                 message = websocket.receive()
                 LOG.debug('message received: %r', message)
@@ -207,10 +251,62 @@ class SocketServer(object):
             LOG.debug("socket failed: %r", e)
         finally:
             self.metrics.counter("conn.lost").increment()
-            self._send_message("disconnect", {"namespace": namespace})
+            for namespace in namespaces:
+                self._send_message("disconnect", {"namespace": namespace})
             self.connections.remove(websocket)
+            if environ.get("supports_compression"):
+                self.compressed_connections -= 1
             dispatcher.kill()
 
+        return []
+
+    def get_stats(self):
+        """Return a snapshot of the server's counters.
+
+        Everything here is maintained incrementally as connections and
+        messages come and go, so this is cheap no matter how many
+        connections are open.
+
+        """
+        connections = len(self.connections)
+        stats = {
+            "quiesced": self.quiesced,
+            "connections": connections,
+            "compression": {
+                "permessage-deflate": self.compressed_connections,
+                "none": connections - self.compressed_connections,
+            },
+            "dispatcher": self.dispatcher.get_stats(),
+        }
+        if self.message_source:
+            stats["source"] = self.message_source.get_stats()
+        if self.ssl_context:
+            session_stats = self.ssl_context.session_stats()
+            stats["tls"] = {
+                "handshakes": session_stats["accept_good"],
+                "sessions_resumed": session_stats["hits"],
+            }
+        return stats
+
+    def _stats(self, environ, start_response):
+        if not self._authorized_to_quiesce(environ):
+            start_response("401 Unauthorized", [])
+            return ["invalid authentication"]
+
+        params = urlparse.parse_qs(environ.get("QUERY_STRING", ""))
+        stats = self.get_stats()
+
+        if params.get("format") == ["prometheus"]:
+            start_response("200 OK", [
+                ("Content-Type", PROMETHEUS_CONTENT_TYPE),
+            ])
+            return [format_prometheus(stats)]
+
+        start_response("200 OK", [
+            ("Content-Type", "application/json"),
+        ])
+        return [json.dumps(stats)]
+
     def _authorized_to_quiesce(self, environ):
         auth_header = environ.get('HTTP_AUTHORIZATION', None)
         if not auth_header:
@@ -219,6 +315,36 @@ class SocketServer(object):
         assert auth_scheme.lower() == 'basic'
         return auth_token == self.admin_auth
 
+    def _profile(self, environ, start_response):
+        """Profile the process for a while and return the samples."""
+        if not self._authorized_to_quiesce(environ):
+            start_response("401 Unauthorized", [])
+            return ["invalid authentication"]
+
+        if not self.monitor:
+            start_response("404 Not Found", [])
+            return ["profiling is not enabled"]
+
+        try:
+            params = urlparse.parse_qs(environ.get("QUERY_STRING", ""))
+            duration = float(params.get("seconds", ["10"])[0])
+            if not 0 < duration <= MAX_PROFILE_DURATION:
+                raise ValueError
+        except ValueError:
+            start_response("400 Bad Request", [])
+            return ["seconds must be between 0 and %d" % MAX_PROFILE_DURATION]
+
+        try:
+            profile = self.monitor.profile(duration)
+        except ProfilerBusyError:
+            start_response("409 Conflict", [])
+            return ["a profile is already in progress"]
+
+        start_response("200 OK", [
+            ("Content-Type", "application/json"),
+        ])
+        return [json.dumps(profile)]
+
     def _quiesce(self, environ, bypass_auth=False):
         """Set service state to quiesced and shed existing connections."""
         if not bypass_auth and not self._authorized_to_quiesce(environ):
@@ -267,18 +393,25 @@ class SocketServer(object):
 
     def _shutdown(self):
         LOG.info("Shutting down.")
+        # sys.exit only unwinds this greenlet, so the source won't get to
+        # clean up after itself.
+        if self.message_source:
+            self.message_source.close()
         sys.exit()
 
     def _send_message(self, key, value):
         if self.status_publisher:
             self.status_publisher("websocket.%s" % key, value)
 
-    def _pump_dispatcher(self, namespace, websocket, supports_compression):
-        for msg in self.dispatcher.listen(namespace, max_timeout=self.ping_interval):
+    def _pump_dispatcher(self, namespaces, websocket, supports_compression,
+                         envelope=False):
+        listener = self.dispatcher.listen(
+            namespaces, max_timeout=self.ping_interval, envelope=envelope)
+        for msg in listener:
             if msg is not None:
                 if supports_compression and msg.compressed is not None:
                     send_raw_frame(websocket, msg.compressed)
                 else:
-                    websocket.send(msg.raw)
+                    send_encoded_frame(websocket, msg.raw, binary=msg.binary)
             else:
                 websocket.send_frame("", websocket.OPCODE_PING)
@@ -1,6 +1,11 @@
+from collections import deque
+import datetime
 import json
 import logging
+import random
 import socket
+import time
+import uuid
 
 import gevent
 import haigha.channel_pool
@@ -10,7 +15,69 @@ import haigha.connection
 LOG = logging.getLogger(__name__)
 
 
-class MessageSource(object):
+def is_text_content_type(content_type):
+    """Return whether a message's content type means it's utf-8 text.
+
+    Messages without a content type are assumed to be text since that's all
+    publishers could send before binary messages were supported.
+
+    """
+    if not content_type:
+        return True
+
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return (media_type.startswith("text/") or
+            media_type == "application/json" or
+            media_type.endswith("+json"))
+
+
+class BaseMessageSource(object):
+    """Where the messages we broadcast to clients come from.
+
+    The application sets `message_handler` to a callable which takes
+    `namespace` and `message` keyword arguments; the source calls it for each
+    message to be broadcast.  Text messages are passed as unicode.  Binary
+    ones are passed as byte strings along with `binary=True`.  In the other
+    direction, `send_message` reports status changes (like clients
+    connecting) back to the backend.
+
+    """
+
+    def __init__(self):
+        self.message_handler = None
+
+    @property
+    def connected(self):
+        """Whether the source is currently able to receive messages."""
+        raise NotImplementedError
+
+    def get_stats(self):
+        """Return a dict of counters for the /stats endpoint.
+
+        This should contain at least `connected`, `messages_received` and
+        `broker_lag` (which may be None).
+
+        """
+        raise NotImplementedError
+
+    def send_message(self, key, payload):
+        """Report a status update, e.g. a client connecting."""
+        raise NotImplementedError
+
+    def pump_messages(self):
+        """Receive messages forever.
+
+        This will never return, so it should be run from a separate greenlet.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Clean up anything left outside the process before it exits."""
+        pass
+
+
+class MessageSource(BaseMessageSource):
     """An AMQP based message source.
 
     This will monitor a fanout exchange on AMQP and signal on receipt of any
@@ -19,26 +86,69 @@ class MessageSource(object):
 
     """
 
-    def __init__(self, config):
-        assert config.endpoint.family == socket.AF_INET
+    def __init__(self, config, metrics):
+        super(MessageSource, self).__init__()
+        self.endpoints = [config.endpoint] + list(config.fallback_endpoints)
+        for endpoint in self.endpoints:
+            assert endpoint.family == socket.AF_INET
 
-        self.host = config.endpoint.address.host
-        self.port = config.endpoint.address.port
         self.vhost = config.vhost
         self.username = config.username
         self.password = config.password
         self.broadcast_exchange = config.exchange.broadcast
         self.status_exchange = config.exchange.status
         self.send_status_messages = config.send_status_messages
-        self.message_handler = None
+        self.reconnect_delay_min = config.reconnect_delay.min
+        self.reconnect_delay_max = config.reconnect_delay.max
+        self.queue_ttl = config.queue_ttl
+        self.metrics = metrics
 
+        # neither hostname nor pid is unique to this process when containers
+        # share a network and their pid namespaces hand out the same pids.
+        self.process_id = uuid.uuid4().hex
+
+        self.connection = None
         self.channel = None
         self.publish_channel = None
+        self.publisher = None
+
+        # status messages sent while we're disconnected are held here and
+        # published once we're back.  the oldest are dropped when it's full.
+        self.pending_status_messages = deque(maxlen=config.status_buffer_size)
+
+        self.consuming = False
+        self.disconnected_at = None
+        self.connections_made = 0
+        self.reconnects = 0
+        self.messages_received = 0
+        self.messages_recovered = 0
+        self.status_messages_dropped = 0
+        self.broker_lag = None
+
+    @property
+    def queue_name(self):
+        """The name of this process's queue, or "" for a temporary queue.
+
+        If a queue TTL is configured, each process consumes from its own named
+        queue which outlives the connection, so that broadcasts sent while
+        we're reconnecting are waiting for us when we get back.  The broker
+        throws away the queue if nobody consumes from it for the TTL, and
+        messages that sit in it for longer than that, so a process that never
+        comes back doesn't leave a queue growing forever.  The name is unique
+        to this process, so it never shares a queue (and so half its
+        broadcasts) with another worker or drains one left behind by a dead
+        one.
 
-    def _connect(self):
+        """
+        if not self.queue_ttl:
+            return ""
+        return "%s.%s.%s" % (
+            self.broadcast_exchange, socket.gethostname(), self.process_id)
+
+    def _connect(self, endpoint):
         self.connection = haigha.connection.Connection(
-            host=self.host,
-            port=self.port,
+            host=endpoint.address.host,
+            port=endpoint.address.port,
             vhost=self.vhost,
             user=self.username,
             password=self.password,
@@ -51,58 +161,170 @@ class MessageSource(object):
 
         self.channel = self.connection.channel()
         self.channel.exchange.declare(exchange=self.broadcast_exchange, type="fanout")
-        self.channel.queue.declare(
-            exclusive=True,
-            auto_delete=True,
-            durable=False,
-            cb=self._on_queue_created,
-        )
+
+        if self.queue_ttl:
+            ttl_ms = self.queue_ttl * 1000
+            self.channel.queue.declare(
+                queue=self.queue_name,
+                exclusive=False,
+                auto_delete=False,
+                durable=True,
+                arguments={"x-expires": ttl_ms, "x-message-ttl": ttl_ms},
+                cb=self._on_queue_created,
+            )
+        else:
+            self.channel.queue.declare(
+                exclusive=True,
+                auto_delete=True,
+                durable=False,
+                cb=self._on_queue_created,
+            )
 
     @property
     def connected(self):
         return bool(self.connection)
 
-    def _on_queue_created(self, queue_name, *ignored):
+    def _on_queue_created(self, queue_name, message_count, *ignored):
         self.channel.queue.bind(queue=queue_name, exchange=self.broadcast_exchange)
         self.channel.basic.consume(
             queue=queue_name,
             consumer=self._on_message,
         )
+        self.consuming = True
+        self.connections_made += 1
+        LOG.info("connected, consuming from %s",
+                 self.queue_name or "a temporary queue")
+
+        if self.disconnected_at is not None:
+            outage = time.time() - self.disconnected_at
+            self.disconnected_at = None
+            self.reconnects += 1
+            self.metrics.timer("amqp.reconnect").send(outage)
+            LOG.info("reconnected after %.2fs", outage)
+
+            # anything already waiting in a persistent queue arrived while
+            # we were away and would otherwise have been lost.
+            if message_count:
+                self.messages_recovered += message_count
+                self.metrics.counter("amqp.messages.recovered").increment(
+                    message_count)
+
+        self._flush_status_messages()
 
     def _on_message(self, message):
+        self.messages_received += 1
+
+        # AMQP timestamps only have one second resolution, but that's plenty
+        # to notice when we're falling behind the broker.
+        timestamp = message.properties.get("timestamp")
+        if timestamp:
+            lag = datetime.datetime.utcnow() - timestamp
+            self.broker_lag = max(lag.total_seconds(), 0.)
+
         if self.message_handler:
-            decoded = message.body.decode("utf-8")
             namespace = message.delivery_info["routing_key"]
-            self.message_handler(namespace=namespace, message=decoded)
+            content_type = message.properties.get("content_type")
+            if is_text_content_type(content_type):
+                decoded = message.body.decode("utf-8")
+                self.message_handler(namespace=namespace, message=decoded)
+            else:
+                self.message_handler(namespace=namespace,
+                                     message=str(message.body), binary=True)
 
     def _on_close(self):
-        LOG.warning("lost connection")
+        if self.consuming:
+            LOG.warning("lost connection")
+            self.metrics.counter("amqp.disconnect").increment()
+            self.disconnected_at = time.time()
+        self.consuming = False
         self.connection = None
         self.channel = None
         self.publisher = None
 
+    def get_stats(self):
+        return {
+            "connected": self.connected,
+            "messages_received": self.messages_received,
+            "broker_lag": self.broker_lag,
+            "reconnects": self.reconnects,
+            "messages_recovered": self.messages_recovered,
+            "status_messages_pending": len(self.pending_status_messages),
+            "status_messages_dropped": self.status_messages_dropped,
+        }
+
     def send_message(self, key, payload):
-        """Publish a status update to the status exchange."""
-        if self.send_status_messages and self.publisher:
-            serialized_payload = json.dumps(payload).encode("utf-8")
-            message = haigha.message.Message(serialized_payload)
-            self.publisher.publish(message, self.status_exchange, routing_key=key)
+        """Publish a status update to the status exchange.
+
+        If we're not connected to the broker right now, the update is buffered
+        and sent once we reconnect.
+
+        """
+        if not self.send_status_messages:
+            return
+
+        serialized_payload = json.dumps(payload).encode("utf-8")
+        if self.consuming:
+            self._publish_status_message(key, serialized_payload)
+        else:
+            pending = self.pending_status_messages
+            if len(pending) == pending.maxlen:
+                self.status_messages_dropped += 1
+                self.metrics.counter("amqp.status.dropped").increment()
+            pending.append((key, serialized_payload))
+
+    def _publish_status_message(self, key, serialized_payload):
+        message = haigha.message.Message(serialized_payload)
+        self.publisher.publish(message, self.status_exchange, routing_key=key)
+
+    def _flush_status_messages(self):
+        while self.pending_status_messages and self.consuming:
+            key, serialized_payload = self.pending_status_messages.popleft()
+            self._publish_status_message(key, serialized_payload)
+
+    def _get_reconnect_delay(self, failures):
+        """Return how long to wait before the next connection attempt.
+
+        The delay doubles with each consecutive failure, up to a limit, and is
+        jittered so that every process on a host doesn't hit the broker at
+        the same moment.
+
+        """
+        # cap the exponent so that a long enough outage can't overflow it.
+        delay = min(self.reconnect_delay_min * 2 ** min(failures, 32),
+                    self.reconnect_delay_max)
+        return delay / 2 + random.uniform(0, delay / 2)
 
     def pump_messages(self):
         """Maintain a connection to the broker and handle incoming frames.
 
+        When the connection fails, we try each configured endpoint in turn,
+        backing off between attempts.
+
         This will never return, so it should be run from a separate greenlet.
 
         """
+        failures = 0
         while True:
+            endpoint = self.endpoints[failures % len(self.endpoints)]
+            connections_made = self.connections_made
+            LOG.info("connecting to %s:%d", *endpoint.address)
             try:
-                self._connect()
-                LOG.info("connected")
+                self._connect(endpoint)
 
                 while self.connected:
                     LOG.debug("pumping")
                     self.connection.read_frames()
                     gevent.sleep()
             except socket.error as exception:
-                LOG.warning("connection failed: %s", exception)
-                gevent.sleep(1)
+                LOG.warning("connection to %s:%d failed: %s",
+                            endpoint.address.host, endpoint.address.port,
+                            exception)
+                self._on_close()
+
+            if self.connections_made != connections_made:
+                # we were happily connected until just now, so start over with
+                # the preferred endpoint and the shortest delay.
+                failures = 0
+            else:
+                failures += 1
+            gevent.sleep(self._get_reconnect_delay(failures))
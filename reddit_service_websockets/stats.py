@@ -0,0 +1,115 @@
+"""Rendering of the service's stats for the /stats endpoint."""
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape_label_value(value):
+    return (str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join('%s="%s"' % (key, _escape_label_value(value))
+                     for key, value in sorted(labels.items()))
+    return "{%s}" % pairs
+
+
+class _PrometheusWriter(object):
+    def __init__(self, metric_prefix):
+        self.metric_prefix = metric_prefix
+        self.lines = []
+
+    def metric(self, name, metric_type, help_text, samples):
+        """Add a metric. `samples` is a list of (labels, value) pairs."""
+        name = self.metric_prefix + name
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s %s" % (name, metric_type))
+        for labels, value in samples:
+            if value is None:
+                continue
+            self.lines.append("%s%s %s" % (
+                name, _format_labels(labels), float(value)))
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def format_prometheus(stats, metric_prefix="websockets_"):
+    """Render the dict built by `SocketServer.get_stats` as Prometheus text."""
+    writer = _PrometheusWriter(metric_prefix)
+
+    writer.metric("quiesced", "gauge",
+                  "Whether the server is shedding connections.",
+                  [({}, stats["quiesced"])])
+    writer.metric("connections", "gauge",
+                  "Open websocket connections.",
+                  [({}, stats["connections"])])
+    writer.metric("connections_by_compression", "gauge",
+                  "Open websocket connections by negotiated compression.",
+                  [({"compression": compression}, count)
+                   for compression, count in stats["compression"].items()])
+
+    dispatcher = stats["dispatcher"]
+    writer.metric("listeners", "gauge",
+                  "Dispatcher listeners by top-level namespace.",
+                  [({"prefix": prefix}, count) for prefix, count
+                   in dispatcher["listeners_by_prefix"].items()])
+    writer.metric("namespaces", "gauge",
+                  "Namespaces known to the dispatcher by whether they're listened to.",
+                  [({"state": "active"}, dispatcher["namespaces"]),
+                   ({"state": "cached"}, dispatcher["namespaces_cached"])])
+    writer.metric("queued_messages", "gauge",
+                  "Messages waiting to be written to sockets.",
+                  [({}, dispatcher["queued_messages"])])
+    writer.metric("queued_bytes", "gauge",
+                  "Size of messages waiting to be written to sockets.",
+                  [({}, dispatcher["queued_bytes"])])
+    writer.metric("dispatched_messages_total", "counter",
+                  "Messages handed to the dispatcher.",
+                  [({}, dispatcher["messages_received"])])
+    writer.metric("compressed_messages_total", "counter",
+                  "Messages large enough to be compressed.",
+                  [({}, dispatcher["messages_compressed"])])
+    writer.metric("coalesced_messages_total", "counter",
+                  "Messages superseded by a newer one before being sent.",
+                  [({}, dispatcher["messages_coalesced"])])
+
+    source = stats.get("source")
+    if source:
+        writer.metric("source_connected", "gauge",
+                      "Whether the message source is connected.",
+                      [({}, source["connected"])])
+        writer.metric("source_messages_total", "counter",
+                      "Messages received from the message source.",
+                      [({}, source["messages_received"])])
+        writer.metric("source_broker_lag_seconds", "gauge",
+                      "Age of the last message received from the broker.",
+                      [({}, source["broker_lag"])])
+        writer.metric("source_reconnects_total", "counter",
+                      "Times the message source has reconnected.",
+                      [({}, source.get("reconnects"))])
+        writer.metric("source_messages_recovered_total", "counter",
+                      "Messages that waited in the queue during an outage.",
+                      [({}, source.get("messages_recovered"))])
+        writer.metric("source_status_messages_pending", "gauge",
+                      "Status messages buffered until the broker is back.",
+                      [({}, source.get("status_messages_pending"))])
+        writer.metric("source_status_messages_dropped_total", "counter",
+                      "Status messages lost because the buffer was full.",
+                      [({}, source.get("status_messages_dropped"))])
+
+    tls = stats.get("tls")
+    if tls:
+        writer.metric("tls_handshakes_total", "counter",
+                      "Completed TLS handshakes, including resumptions.",
+                      [({}, tls["handshakes"])])
+        writer.metric("tls_sessions_resumed_total", "counter",
+                      "TLS handshakes that resumed an earlier session.",
+                      [({}, tls["sessions_resumed"])])
+
+    return writer.render()
@@ -0,0 +1,205 @@
+"""A message source for publishers running on the same host.
+
+Each worker process listens on its own unix domain socket in a configured
+directory, named for its pid.  Local publishers connect to every socket in
+the directory and write length-prefixed frames straight into the workers,
+skipping the round trip through the AMQP broker.  Sockets are created with
+`unix.mode` permissions since anything that can connect to one can broadcast
+to every client.
+
+A worker removes its socket when it shuts down, but one that crashes or is
+killed leaves it behind, so publishers must skip sockets that refuse
+connections.
+
+A frame is laid out as follows (all integers big-endian):
+
+    +-----------+-----------+-----------+----------------+
+    | length    | ns length | namespace | payload        |
+    | (4 bytes) | (2 bytes) | (utf-8)   | (utf-8 or raw) |
+    +-----------+-----------+-----------+----------------+
+
+where `length` counts everything after itself.  The top bit of `ns length`
+marks a binary payload, which is passed through to clients untouched rather
+than decoded as text.  Use `encode_frame` to build them.
+
+"""
+import errno
+import logging
+import os
+import socket
+import struct
+
+import gevent
+import gevent.server
+import gevent.socket
+
+from .source import BaseMessageSource
+
+
+LOG = logging.getLogger(__name__)
+
+
+FRAME_HEADER = struct.Struct("!IH")
+
+FLAG_BINARY = 0x8000
+NAMESPACE_LENGTH_MASK = 0x7fff
+
+# frames bigger than this are assumed to be garbage and the publisher is
+# disconnected.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+RECV_SIZE = 64 * 1024
+
+
+def encode_frame(namespace, message, binary=False):
+    """Encode a message for delivery to a namespace as a wire frame."""
+    if isinstance(namespace, unicode):
+        namespace = namespace.encode("utf-8")
+    if isinstance(message, unicode):
+        message = message.encode("utf-8")
+    assert len(namespace) <= NAMESPACE_LENGTH_MASK
+
+    flags = FLAG_BINARY if binary else 0
+    length = FRAME_HEADER.size - 4 + len(namespace) + len(message)
+    return (FRAME_HEADER.pack(length, len(namespace) | flags) +
+            namespace + message)
+
+
+class UnixSocketMessageSource(BaseMessageSource):
+    """A message source fed directly by local publishers over a unix socket.
+
+    Status messages have nowhere to go with this backend and are discarded.
+
+    """
+
+    def __init__(self, config, metrics):
+        super(UnixSocketMessageSource, self).__init__()
+        self.path = os.path.join(config.directory, "%d.sock" % os.getpid())
+        self.mode = config.mode
+        self.metrics = metrics
+        self.server = None
+        self.publishers = set()
+        self.messages_received = 0
+        self.frames_rejected = 0
+
+    @property
+    def connected(self):
+        return bool(self.server and self.server.started)
+
+    def _listen(self):
+        try:
+            os.unlink(self.path)
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+
+        listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # set the umask rather than chmod afterwards so that nobody else can
+        # sneak a connection in before the permissions are right.
+        umask = os.umask(~self.mode & 0o777)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(128)
+        return listener
+
+    def _handle_publisher(self, sock, address):
+        self.publishers.add(sock)
+        buf = bytearray()
+        try:
+            while True:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    break
+
+                buf.extend(data)
+                consumed = self._handle_frames(buf)
+                if consumed < 0:
+                    LOG.warning("dropping publisher sending oversized frame")
+                    break
+                del buf[:consumed]
+
+                # a busy publisher always has more data for us, don't let it
+                # starve everything else.
+                gevent.sleep()
+        except socket.error as exception:
+            LOG.warning("publisher connection failed: %s", exception)
+        finally:
+            self.publishers.discard(sock)
+            sock.close()
+
+    def _handle_frames(self, buf):
+        """Dispatch each complete frame in `buf`.
+
+        Returns the number of bytes consumed, or -1 if the buffer holds a
+        frame that's too big to be legitimate.
+
+        """
+        offset = 0
+        while len(buf) - offset >= FRAME_HEADER.size:
+            length, namespace_length = FRAME_HEADER.unpack_from(buf, offset)
+            binary = bool(namespace_length & FLAG_BINARY)
+            namespace_length &= NAMESPACE_LENGTH_MASK
+            if length > MAX_FRAME_SIZE or namespace_length > length - 2:
+                self.frames_rejected += 1
+                self.metrics.counter("unix_source.rejected").increment()
+                return -1
+
+            end = offset + 4 + length
+            if len(buf) < end:
+                break
+
+            namespace_start = offset + FRAME_HEADER.size
+            payload_start = namespace_start + namespace_length
+            namespace = str(buf[namespace_start:payload_start])
+            payload = buf[payload_start:end]
+            offset = end
+
+            if binary:
+                message = str(payload)
+            else:
+                try:
+                    message = payload.decode("utf-8")
+                except UnicodeDecodeError:
+                    self.frames_rejected += 1
+                    self.metrics.counter("unix_source.rejected").increment()
+                    continue
+
+            self.messages_received += 1
+            if self.message_handler:
+                if binary:
+                    self.message_handler(namespace=namespace, message=message,
+                                         binary=True)
+                else:
+                    self.message_handler(namespace=namespace, message=message)
+
+        return offset
+
+    def get_stats(self):
+        return {
+            "connected": self.connected,
+            "messages_received": self.messages_received,
+            "broker_lag": None,
+            "publishers": len(self.publishers),
+            "frames_rejected": self.frames_rejected,
+        }
+
+    def send_message(self, key, payload):
+        pass
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def pump_messages(self):
+        """Accept publisher connections until the process exits."""
+        self.server = gevent.server.StreamServer(
+            self._listen(), self._handle_publisher)
+        LOG.info("listening for local publishers on %s", self.path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
@@ -0,0 +1,103 @@
+import os
+import unittest
+from distutils.spawn import find_executable
+
+import gevent.socket
+import gevent.subprocess
+from gevent import ssl
+from baseplate.secrets import SecretsStore
+from mock import Mock
+
+from reddit_service_websockets.server import make_server, OP_NO_TICKET
+from reddit_service_websockets.socketserver import SocketServer
+
+
+CERTIFICATE_PATH = os.path.join(os.path.dirname(__file__), "selfsigned.pem")
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.app = SocketServer(
+            metrics=Mock(),
+            dispatcher=Mock(),
+            secrets=SecretsStore("example_secrets.json"),
+            error_reporter=None,
+            ping_interval=1,
+            admin_auth='test-auth',
+            conn_shed_rate=5,
+        )
+        self.app.dispatcher.get_stats.return_value = {}
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+
+    def start_server(self, **server_config):
+        listener = gevent.socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(128)
+        server_config.setdefault("max_concurrency", "100")
+        self.server = make_server(server_config, listener, self.app)
+        self.server.start()
+        return self.server.address
+
+    def get_health(self, sock):
+        sock.sendall("GET /health HTTP/1.0\r\n\r\n")
+        status_line = sock.makefile().readline()
+        sock.close()
+        return status_line.rstrip()
+
+    def test_plain_without_certificate(self):
+        address = self.start_server()
+
+        sock = gevent.socket.create_connection(address)
+        self.assertEqual(self.get_health(sock), "HTTP/1.1 200 OK")
+        self.assertIsNone(self.app.ssl_context)
+        self.assertEqual(self.server.environ["wsgi.url_scheme"], "http")
+        self.assertNotIn("tls", self.app.get_stats())
+
+    def test_terminates_tls(self):
+        address = self.start_server(**{"tls.certificate": CERTIFICATE_PATH})
+
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(CERTIFICATE_PATH)
+        sock = context.wrap_socket(gevent.socket.create_connection(address))
+        self.assertEqual(self.get_health(sock), "HTTP/1.1 200 OK")
+        self.assertEqual(self.server.environ["wsgi.url_scheme"], "https")
+
+        stats = self.app.get_stats()["tls"]
+        self.assertEqual(stats["handshakes"], 1)
+        self.assertEqual(stats["sessions_resumed"], 0)
+
+    def test_session_tickets(self):
+        self.start_server(**{"tls.certificate": CERTIFICATE_PATH})
+        self.assertFalse(self.app.ssl_context.options & OP_NO_TICKET)
+
+        self.server.stop()
+        self.start_server(**{
+            "tls.certificate": CERTIFICATE_PATH,
+            "tls.session_tickets": "false",
+        })
+        self.assertTrue(self.app.ssl_context.options & OP_NO_TICKET)
+
+    def test_resumes_sessions(self):
+        # python 2 clients can't resume sessions, so borrow openssl's. its
+        # -reconnect doesn't wait for TLS 1.3's post-handshake tickets.
+        openssl = find_executable("openssl")
+        if not openssl:
+            raise unittest.SkipTest("openssl not installed")
+
+        address = self.start_server(**{"tls.certificate": CERTIFICATE_PATH})
+        client = gevent.subprocess.Popen(
+            [openssl, "s_client", "-tls1_2", "-reconnect",
+             "-connect", "%s:%d" % address],
+            stdin=gevent.subprocess.PIPE,
+            stdout=gevent.subprocess.PIPE,
+            stderr=gevent.subprocess.STDOUT,
+        )
+        client.communicate("")
+
+        stats = self.app.get_stats()["tls"]
+        self.assertGreater(stats["sessions_resumed"], 0)
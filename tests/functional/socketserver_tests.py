@@ -1,11 +1,24 @@
+import base64
+import datetime
+import os
+import struct
 import unittest
+import urllib
 
+import gevent.pywsgi
+import gevent.socket
+from baseplate.crypto import make_signature
 from baseplate.secrets import SecretsStore
 import webtest
-from mock import Mock, patch
+from mock import MagicMock, Mock, patch
 
 import reddit_service_websockets as ws
-from reddit_service_websockets.socketserver import SocketServer
+from reddit_service_websockets.dispatcher import MessageDispatcher
+from reddit_service_websockets.socketserver import (
+    MAX_NAMESPACES,
+    SocketServer,
+    WebSocketHandler,
+)
 
 NOT_WEBSOCKET_RESP_BODY = 'you are not a websocket'
 
@@ -22,6 +35,9 @@ class WebsocketServiceTests(unittest.TestCase):
             conn_shed_rate=5,
         )
         self.test_app = webtest.TestApp(self.app)
+        self.auth_header = {
+            'Authorization': 'Basic ' + self.app.admin_auth
+        }
 
     def test_health(self):
         resp = self.test_app.get('/health')
@@ -74,3 +90,225 @@ class WebsocketServiceTests(unittest.TestCase):
         self.assertEqual(resp.status_code, 410)
         self.assertEqual(resp.body, '{"status": "quiesced", "connections": 1}')
 
+    def test_profile_unauthorized(self):
+        resp = self.test_app.get('/profile',
+                                 expect_errors=True,
+                                 headers={})
+        self.assertEqual(resp.status_code, 401)
+
+    def test_profile_not_enabled(self):
+        auth_header = {
+            'Authorization': 'Basic ' + self.app.admin_auth
+        }
+        resp = self.test_app.get('/profile',
+                                 expect_errors=True,
+                                 headers=auth_header)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_profile_bad_duration(self):
+        self.app.monitor = Mock()
+        auth_header = {
+            'Authorization': 'Basic ' + self.app.admin_auth
+        }
+        resp = self.test_app.get('/profile?seconds=3600',
+                                 expect_errors=True,
+                                 headers=auth_header)
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.monitor.profile.called)
+
+    def test_profile_authorized(self):
+        self.app.monitor = Mock()
+        self.app.monitor.profile.return_value = {"samples": 0}
+        auth_header = {
+            'Authorization': 'Basic ' + self.app.admin_auth
+        }
+        resp = self.test_app.get('/profile?seconds=2',
+                                 headers=auth_header)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {"samples": 0})
+        self.app.monitor.profile.assert_called_with(2.0)
+
+    def test_stats_unauthorized(self):
+        resp = self.test_app.get('/stats', expect_errors=True)
+        self.assertEqual(resp.status_code, 401)
+
+    def test_stats(self):
+        self.app.dispatcher = MessageDispatcher(metrics=Mock())
+        self.app.message_source = Mock()
+        self.app.message_source.get_stats.return_value = {
+            "connected": True,
+            "messages_received": 3,
+            "broker_lag": None,
+        }
+        self.app.connections = set([Mock(), Mock()])
+        self.app.compressed_connections = 1
+
+        resp = self.test_app.get('/stats', headers=self.auth_header)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["connections"], 2)
+        self.assertEqual(resp.json["compression"],
+                         {"permessage-deflate": 1, "none": 1})
+        self.assertEqual(resp.json["dispatcher"]["queued_messages"], 0)
+        self.assertTrue(resp.json["source"]["connected"])
+
+    def test_stats_prometheus(self):
+        self.app.dispatcher = MessageDispatcher(metrics=Mock())
+        resp = self.test_app.get('/stats?format=prometheus',
+                                 headers=self.auth_header)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('websockets_connections 0.0\n', resp.body)
+        self.assertIn(
+            'websockets_connections_by_compression{compression="none"} 0.0',
+            resp.body)
+
+    def test_stats_while_quiesced(self):
+        self.app.dispatcher = MessageDispatcher(metrics=Mock())
+        self.app.quiesced = True
+        resp = self.test_app.get('/stats', headers=self.auth_header)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.json["quiesced"])
+
+
+class WebSocketHandshakeTests(unittest.TestCase):
+    def setUp(self):
+        self.secrets = SecretsStore("example_secrets.json")
+        self.app = SocketServer(
+            metrics=Mock(),
+            dispatcher=MessageDispatcher(metrics=MagicMock()),
+            secrets=self.secrets,
+            error_reporter=None,
+            ping_interval=1,
+            admin_auth='test-auth',
+            conn_shed_rate=5,
+        )
+        self.server = gevent.pywsgi.WSGIServer(
+            ("127.0.0.1", 0),
+            self.app,
+            handler_class=WebSocketHandler,
+            log=None,
+        )
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def sign(self, namespaces):
+        secret = self.secrets.get_versioned(
+            "secret/websockets/authorization_key")
+        return make_signature(secret, "\n".join(namespaces),
+                              max_age=datetime.timedelta(minutes=5))
+
+    def connect(self, path, extra_namespaces=(), signature=None, params=()):
+        """Open a websocket and return its status and a file to read from."""
+        if signature is None:
+            signature = self.sign([path] + list(extra_namespaces))
+        params = ([("m", signature)] +
+                  [("ns", ns) for ns in extra_namespaces] +
+                  list(params))
+
+        sock = gevent.socket.create_connection(
+            self.server.address, timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall("\r\n".join([
+            "GET %s?%s HTTP/1.1" % (path, urllib.urlencode(params)),
+            "Host: localhost",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Key: %s" % base64.b64encode(os.urandom(16)),
+            "Sec-WebSocket-Version: 13",
+            "", "",
+        ]))
+        reader = sock.makefile()
+        self.addCleanup(reader.close)
+        status = reader.readline().split()[1]
+        while reader.readline() not in ("\r\n", ""):
+            pass
+        return status, reader
+
+    def handshake(self, path, extra_namespaces=(), signature=None):
+        status, _ = self.connect(path, extra_namespaces, signature)
+        return status
+
+    def read_frame(self, reader):
+        """Read an unmasked, uncompressed frame and return its opcode and
+        payload."""
+        first, length = struct.unpack("!BB", reader.read(2))
+        if length == 126:
+            length, = struct.unpack("!H", reader.read(2))
+        return first & 0x0f, reader.read(length)
+
+    def wait_for_listeners(self, count):
+        stats = self.app.dispatcher.get_stats
+        while sum(stats()["listeners_by_prefix"].values()) < count:
+            gevent.sleep(0.01)
+
+    def test_single_namespace(self):
+        self.assertEqual(self.handshake("/live/abc"), "101")
+
+    def test_multiple_namespaces(self):
+        self.assertEqual(
+            self.handshake("/live/abc", ["/live/def", "/other/*"]), "101")
+
+    def test_reordered_namespaces_rejected(self):
+        signature = self.sign(["/live/abc", "/live/def", "/other"])
+        status = self.handshake(
+            "/live/abc", ["/other", "/live/def"], signature=signature)
+        self.assertEqual(status, "403")
+
+    def test_extra_namespace_rejected(self):
+        signature = self.sign(["/live/abc"])
+        status = self.handshake(
+            "/live/abc", ["/live/def"], signature=signature)
+        self.assertEqual(status, "403")
+
+    def test_unrooted_namespace_rejected(self):
+        self.assertEqual(self.handshake("/live/abc", ["other"]), "403")
+
+    def test_namespace_with_newline_rejected(self):
+        self.assertEqual(self.handshake("/live/abc", ["/a\n/b"]), "403")
+
+    def test_text_messages_sent_as_utf8(self):
+        status, reader = self.connect("/live/abc")
+        self.assertEqual(status, "101")
+        self.wait_for_listeners(1)
+
+        self.app.dispatcher.on_message_received("/live/abc", u"\u2603")
+
+        opcode, payload = self.read_frame(reader)
+        self.assertEqual(opcode, 0x1)
+        self.assertEqual(payload, "\xe2\x98\x83")
+
+    def test_envelope_tells_namespaces_apart(self):
+        status, reader = self.connect(
+            "/live/abc", ["/live/def", "/other/*"], params=[("envelope", "1")])
+        self.assertEqual(status, "101")
+        self.wait_for_listeners(1)
+
+        self.app.dispatcher.on_message_received("/live/def", u"one")
+        self.app.dispatcher.on_message_received("/other/ghi", u"two")
+        self.app.dispatcher.on_message_received("/live/abc", u"three")
+
+        received = []
+        for _ in range(3):
+            opcode, payload = self.read_frame(reader)
+            self.assertEqual(opcode, 0x1)
+            received.append(tuple(payload.split("\n", 1)))
+        self.assertEqual(received, [
+            ("/live/def", "one"),
+            ("/other/ghi", "two"),
+            ("/live/abc", "three"),
+        ])
+
+    def test_no_envelope_by_default(self):
+        status, reader = self.connect("/live/abc", ["/live/def"])
+        self.wait_for_listeners(1)
+
+        self.app.dispatcher.on_message_received("/live/def", u"one")
+
+        self.assertEqual(self.read_frame(reader), (0x1, "one"))
+
+    def test_too_many_namespaces_rejected(self):
+        namespaces = ["/live/%d" % i for i in range(MAX_NAMESPACES)]
+        self.assertEqual(self.handshake("/live", namespaces[1:]), "101")
+        self.assertEqual(self.handshake("/live", namespaces), "403")
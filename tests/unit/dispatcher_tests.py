@@ -0,0 +1,371 @@
+"""Unit tests for MessageDispatcher."""
+import json
+import unittest
+import zlib
+
+import gevent
+from geventwebsocket.websocket import WebSocket
+from mock import MagicMock
+
+from reddit_service_websockets.dispatcher import (
+    CoalesceRule,
+    MessageDispatcher,
+    _NamespaceTable,
+    parse_coalesce_rules,
+)
+
+
+class MessageDispatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = MessageDispatcher(metrics=MagicMock())
+
+    def listen(self, *namespaces, **kwargs):
+        listener = self.dispatcher.listen(
+            namespaces, max_timeout=0.01, **kwargs)
+        # listeners register themselves on first use, this times out at once
+        self.assertIsNone(next(listener))
+        return listener
+
+    def test_delivers_to_namespace_and_descendants(self):
+        parent = self.listen("/live")
+        child = self.listen("/live/abc")
+        other = self.listen("/other")
+
+        self.dispatcher.on_message_received("/live", "hello")
+
+        self.assertEqual(next(parent).raw, "hello")
+        self.assertEqual(next(child).raw, "hello")
+        self.assertIsNone(next(other))
+
+    def test_multiple_namespaces(self):
+        listener = self.listen("/live/abc", "/live/def", "/other")
+
+        self.dispatcher.on_message_received("/live/def", "one")
+        self.dispatcher.on_message_received("/other", "two")
+        # both subscriptions share the /live ancestor, only deliver once
+        self.dispatcher.on_message_received("/live", "three")
+        self.dispatcher.on_message_received("/live/ghi", "nope")
+
+        self.assertEqual(next(listener).raw, "one")
+        self.assertEqual(next(listener).raw, "two")
+        self.assertEqual(next(listener).raw, "three")
+        self.assertIsNone(next(listener))
+
+    def test_wildcard(self):
+        listener = self.listen("/live/*")
+
+        self.dispatcher.on_message_received("/live", "one")
+        self.dispatcher.on_message_received("/live/abc/def", "two")
+        self.dispatcher.on_message_received("/", "three")
+        self.dispatcher.on_message_received("/other", "nope")
+
+        self.assertEqual(next(listener).raw, "one")
+        self.assertEqual(next(listener).raw, "two")
+        self.assertEqual(next(listener).raw, "three")
+        self.assertIsNone(next(listener))
+
+    def test_wildcard_ignores_unrooted_namespaces(self):
+        listener = self.listen("/live/*")
+
+        self.dispatcher.on_message_received("live", "nope")
+
+        self.assertIsNone(next(listener))
+
+    def test_wildcard_ignores_namespaces_with_newlines(self):
+        listener = self.listen("/live/*")
+
+        self.dispatcher.on_message_received("/live/a\nb", "nope")
+
+        self.assertIsNone(next(listener))
+
+    def test_envelope(self):
+        enveloped = self.listen("/live/abc", "/other/*", envelope=True)
+        plain = self.listen("/live/abc")
+
+        self.dispatcher.on_message_received("/live/abc", u"\u2603")
+        self.dispatcher.on_message_received("/other/def", "x" * 2000)
+
+        message = next(enveloped)
+        self.assertEqual(message.namespace, "/live/abc")
+        self.assertEqual(message.raw, "/live/abc\n\xe2\x98\x83")
+        self.assertFalse(message.binary)
+
+        message = next(enveloped)
+        self.assertEqual(message.raw, "/other/def\n" + "x" * 2000)
+        # the compressed frame carries the envelope too
+        header_size = 4 if message.compressed[1] & 0x7f == 126 else 2
+        payload = str(message.compressed[header_size:])
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(payload), message.raw)
+        self.assertIsNone(next(enveloped))
+
+        message = next(plain)
+        self.assertEqual(message.raw, "\xe2\x98\x83")
+        self.assertIsNone(next(plain))
+
+        self.assertEqual(self.dispatcher.get_stats()["queued_bytes"], 0)
+
+    def test_envelope_forgotten_on_close(self):
+        listener = self.listen("/live", envelope=True)
+        listener.close()
+        self.assertEqual(self.dispatcher.enveloped_listeners, set())
+
+    def test_overlapping_wildcard_delivers_once(self):
+        listener = self.listen("/live/*", "/live/abc/*", "/live/abc")
+
+        self.dispatcher.on_message_received("/live/abc", "one")
+        self.assertEqual(self.dispatcher.queued_messages, 1)
+
+        self.assertEqual(next(listener).raw, "one")
+        self.assertIsNone(next(listener))
+
+    def test_messages_dont_fill_namespace_table(self):
+        listener = self.listen("/live/*")
+
+        self.dispatcher.on_message_received("/live/abc", "hello")
+        self.dispatcher.on_message_received("/nobody/listens", "hello")
+
+        self.assertIsNone(self.dispatcher.namespaces.get("/live/abc"))
+        self.assertIsNone(self.dispatcher.namespaces.get("/nobody/listens"))
+        self.assertEqual(next(listener).raw, "hello")
+
+    def test_unsubscribes_everything(self):
+        listener = self.listen("/live/*", "/other/abc")
+        listener.close()
+
+        for entry in self.dispatcher.namespaces.entries.values():
+            self.assertEqual(entry.refcount, 0)
+            self.assertIsNone(entry.listeners)
+            self.assertIsNone(entry.wildcard_listeners)
+        self.assertEqual(self.dispatcher.wildcard_subscriptions, 0)
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["listeners_by_prefix"], {})
+        self.assertEqual(stats["namespaces"], 0)
+
+    def test_stats_track_listeners(self):
+        first = self.listen("/live/abc")
+        second = self.listen("/live/def")
+        third = self.listen("/other")
+
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["listeners_by_prefix"],
+                         {"/live": 2, "/other": 1})
+
+        first.close()
+        second.close()
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["listeners_by_prefix"], {"/other": 1})
+        third.close()
+
+    def test_stats_track_queued_messages(self):
+        first = self.listen("/live/abc")
+        second = self.listen("/live/def")
+
+        self.dispatcher.on_message_received("/live", "hello")
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["messages_received"], 1)
+        self.assertEqual(stats["queued_messages"], 2)
+        self.assertEqual(stats["queued_bytes"], 10)
+
+        next(first)
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["queued_messages"], 1)
+        self.assertEqual(stats["queued_bytes"], 5)
+
+        # messages still queued when a listener goes away aren't counted
+        second.close()
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["queued_messages"], 0)
+        self.assertEqual(stats["queued_bytes"], 0)
+
+    def test_stats_count_encoded_bytes(self):
+        listener = self.listen("/live")
+
+        self.dispatcher.on_message_received("/live", u"\u2603")
+        self.assertEqual(self.dispatcher.get_stats()["queued_bytes"], 3)
+
+        message = next(listener)
+        self.assertEqual(message.raw, "\xe2\x98\x83")
+        self.assertFalse(message.binary)
+        self.assertEqual(self.dispatcher.get_stats()["queued_bytes"], 0)
+
+    def test_stats_count_compressed_messages(self):
+        self.dispatcher.on_message_received("/live", "small")
+        self.dispatcher.on_message_received("/live", "x" * 2000)
+
+        stats = self.dispatcher.get_stats()
+        self.assertEqual(stats["messages_received"], 2)
+        self.assertEqual(stats["messages_compressed"], 1)
+
+    def test_binary_messages(self):
+        listener = self.listen("/live")
+
+        self.dispatcher.on_message_received("/live", "\x00\xff", binary=True)
+        self.dispatcher.on_message_received("/live", "\x00" * 2000, binary=True)
+        self.dispatcher.on_message_received("/live", "hello")
+
+        message = next(listener)
+        self.assertEqual(message.raw, "\x00\xff")
+        self.assertTrue(message.binary)
+        message = next(listener)
+        self.assertTrue(message.binary)
+        self.assertEqual(message.compressed[0] & 0x0f,
+                         WebSocket.OPCODE_BINARY)
+        self.assertFalse(next(listener).binary)
+
+    def test_binary_namespaces(self):
+        dispatcher = MessageDispatcher(
+            metrics=MagicMock(), binary_namespaces=["/proto/"])
+        listener = dispatcher.listen(["/proto/abc", "/other"], max_timeout=0.01)
+        self.assertIsNone(next(listener))
+
+        dispatcher.on_message_received("/proto/abc", u"\u2603")
+        dispatcher.on_message_received("/other", u"\u2603")
+
+        message = next(listener)
+        self.assertTrue(message.binary)
+        self.assertEqual(message.raw, "\xe2\x98\x83")
+        self.assertFalse(next(listener).binary)
+
+    def test_unrooted_namespace_with_binary_namespaces(self):
+        dispatcher = MessageDispatcher(
+            metrics=MagicMock(),
+            coalesce_rules={"/live": CoalesceRule(window=0.05, key=None)},
+            binary_namespaces=["/proto"],
+        )
+        listener = dispatcher.listen(["/proto/*"], max_timeout=0.01)
+        self.assertIsNone(next(listener))
+
+        dispatcher.on_message_received("proto", u"hello")
+        self.assertEqual(dispatcher.get_stats()["messages_received"], 1)
+        self.assertIsNone(next(listener))
+
+
+class NamespaceTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.table = _NamespaceTable(max_unused=2)
+
+    def test_ancestors(self):
+        self.assertEqual(self.table.ancestors("/live/abc/def"),
+                         ("/live/abc/def", "/live/abc", "/live", "/"))
+        self.assertEqual(self.table.ancestors("/"), ("/",))
+        self.assertEqual(self.table.ancestors("live"), ("live",))
+        self.assertEqual(self.table.peek_ancestors("live"), ("live",))
+
+    def test_names_are_interned(self):
+        name = "".join(["/live/", "abc"])
+        entry = self.table.acquire(name)
+        self.assertIs(entry.name, intern("/live/abc"))
+        self.assertIs(self.table.ancestors("/live/abc/def")[1], entry.name)
+
+    def test_entries_in_use_are_kept(self):
+        entry = self.table.acquire("/live")
+        for i in range(5):
+            self.table.ancestors("/other/%d" % i)
+
+        self.assertIs(self.table.get("/live"), entry)
+        self.assertEqual(len(self.table.entries), 3)
+
+    def test_peek_leaves_table_alone(self):
+        self.table.ancestors("/a")
+        self.table.ancestors("/b")
+
+        self.assertEqual(self.table.peek_ancestors("/a"), ("/a", "/"))
+        self.assertEqual(self.table.peek_ancestors("/c/d"),
+                         ("/c/d", "/c", "/"))
+
+        self.assertEqual(list(self.table.unused), ["/a", "/b"])
+        self.assertIsNone(self.table.get("/c/d"))
+
+    def test_least_recently_used_evicted(self):
+        entry = self.table.acquire("/a")
+        self.table.ancestors("/b")
+        self.table.release(entry)
+        self.table.ancestors("/b")
+        self.table.ancestors("/c")
+
+        self.assertIsNone(self.table.get("/a"))
+        self.assertIsNotNone(self.table.get("/b"))
+        self.assertIsNotNone(self.table.get("/c"))
+
+
+class CoalescingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = MessageDispatcher(
+            metrics=MagicMock(),
+            coalesce_rules={
+                "/live": CoalesceRule(window=0.05, key=None),
+                "/scores": CoalesceRule(window=0.05, key="id"),
+            },
+        )
+        self.listener = self.dispatcher.listen(["/live/abc", "/scores"],
+                                               max_timeout=0.01)
+        self.assertIsNone(next(self.listener))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def receive_all(self):
+        messages = []
+        for message in self.listener:
+            if message is None:
+                return messages
+            messages.append(message.raw)
+
+    def test_parse_rules(self):
+        rules = parse_coalesce_rules(["/live/:250", "/scores:1000:id"])
+        self.assertEqual(rules, {
+            "/live": CoalesceRule(window=0.25, key=None),
+            "/scores": CoalesceRule(window=1., key="id"),
+        })
+
+        with self.assertRaises(ValueError):
+            parse_coalesce_rules(["live:250"])
+
+    def test_sends_first_and_newest(self):
+        for i in range(5):
+            self.dispatcher.on_message_received("/live/abc", str(i))
+
+        self.assertEqual(self.receive_all(), ["0"])
+        gevent.sleep(0.06)
+        self.assertEqual(self.receive_all(), ["4"])
+        self.assertEqual(self.dispatcher.get_stats()["messages_coalesced"], 3)
+
+    def test_window_closes_when_quiet(self):
+        self.dispatcher.on_message_received("/live/abc", "0")
+        gevent.sleep(0.06)
+        self.assertEqual(self.dispatcher.coalescing, {})
+
+        self.dispatcher.on_message_received("/live/abc", "1")
+        self.assertEqual(self.receive_all(), ["0", "1"])
+
+    def test_coalesces_by_key(self):
+        for i in range(3):
+            for thing in ("a", "b"):
+                self.dispatcher.on_message_received(
+                    "/scores", json.dumps({"id": thing, "score": i}))
+
+        first = [json.loads(m) for m in self.receive_all()]
+        self.assertEqual(first, [{"id": "a", "score": 0},
+                                 {"id": "b", "score": 0}])
+        gevent.sleep(0.06)
+        last = sorted(self.receive_all())
+        self.assertEqual([json.loads(m)["score"] for m in last], [2, 2])
+
+    def test_binary_messages_coalesced(self):
+        for i in range(3):
+            self.dispatcher.on_message_received(
+                "/scores", chr(i), binary=True)
+
+        self.assertEqual(self.receive_all(), ["\x00"])
+        gevent.sleep(0.06)
+        self.assertEqual(self.receive_all(), ["\x02"])
+
+    def test_other_namespaces_unaffected(self):
+        self.dispatcher.on_message_received("/", "0")
+        self.dispatcher.on_message_received("/", "1")
+
+        self.assertEqual(self.receive_all(), ["0", "1"])
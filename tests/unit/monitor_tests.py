@@ -0,0 +1,99 @@
+"""Unit tests for HubMonitor."""
+import os
+import signal
+import time
+import unittest
+
+import gevent
+from mock import Mock
+
+from reddit_service_websockets.monitor import (
+    HubMonitor,
+    ProfilerBusyError,
+)
+
+
+def _hog_the_hub(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class HubMonitorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Mock()
+        self.monitor = HubMonitor(metrics=self.metrics, stall_threshold=0.05)
+        self.monitor.start()
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_records_stall(self):
+        gevent.spawn(_hog_the_hub, 0.1).join()
+        gevent.sleep(0)
+
+        self.assertEqual(len(self.monitor.stalls), 1)
+        stall = self.monitor.stalls[0]
+        self.assertEqual(stall.greenlet, "_hog_the_hub")
+        self.assertGreaterEqual(stall.duration, 0.1)
+        self.metrics.counter.assert_called_with("hub.stall")
+
+    def test_stall_reported_after_switch(self):
+        def hog_then_yield():
+            _hog_the_hub(0.1)
+            gevent.sleep(0)
+
+        worker = gevent.spawn(hog_then_yield)
+        gevent.sleep(0)
+
+        # the trace function only notes the stall down while switching
+        self.assertEqual(len(self.monitor.stalls), 0)
+        self.assertFalse(self.metrics.counter.called)
+
+        worker.join()
+        gevent.sleep(0)
+        self.assertEqual(len(self.monitor.stalls), 1)
+        self.assertIn("hog_then_yield", self.monitor.stalls[0].stack)
+
+    def test_ignores_short_runs(self):
+        gevent.spawn(gevent.sleep, 0.1).join()
+        gevent.sleep(0)
+
+        self.assertEqual(len(self.monitor.stalls), 0)
+        self.assertFalse(self.metrics.counter.called)
+
+    def test_disabled_threshold(self):
+        self.monitor.stall_threshold = 0
+        gevent.spawn(_hog_the_hub, 0.1).join()
+        gevent.sleep(0)
+
+        self.assertEqual(len(self.monitor.stalls), 0)
+
+    def test_profile(self):
+        worker = gevent.spawn(_hog_the_hub, 0.2)
+        profile = self.monitor.profile(0.3)
+        worker.join()
+
+        self.assertGreater(profile["samples"], 0)
+        self.assertIn("_hog_the_hub", profile["greenlets"])
+        self.assertTrue(any("_hog_the_hub" in stack
+                            for stack in profile["stacks"]))
+
+    def test_late_samples_ignored(self):
+        self.monitor.profile(0.01)
+
+        os.kill(os.getpid(), signal.SIGPROF)
+        gevent.sleep(0)
+
+        self.assertIsNone(self.monitor._stack_samples)
+
+    def test_profile_only_one_at_a_time(self):
+        first = gevent.spawn(self.monitor.profile, 0.1)
+        gevent.sleep(0)
+
+        with self.assertRaises(ProfilerBusyError):
+            self.monitor.profile(0.1)
+
+        first.join()
+        self.assertIsNotNone(first.value)
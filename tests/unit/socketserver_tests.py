@@ -90,3 +90,10 @@ class SocketServerTests(unittest.TestCase):
         ]
         gevent_patch.assert_has_calls(calls)
 
+
+    def test_shutdown_closes_source(self):
+        self.server.message_source = Mock()
+
+        with self.assertRaises(SystemExit):
+            self.server._shutdown()
+        self.server.message_source.close.assert_called_once_with()
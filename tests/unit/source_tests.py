@@ -0,0 +1,140 @@
+"""Unit tests for MessageSource."""
+import socket
+import unittest
+
+from baseplate import config
+from mock import Mock, patch
+
+from reddit_service_websockets.source import MessageSource
+
+
+def make_config(**overrides):
+    cfg = Mock()
+    cfg.endpoint = config.Endpoint("127.0.0.1:5672")
+    cfg.fallback_endpoints = [config.Endpoint("127.0.0.2:5672")]
+    cfg.vhost = "/"
+    cfg.username = "guest"
+    cfg.password = "guest"
+    cfg.exchange.broadcast = "broadcast"
+    cfg.exchange.status = "status"
+    cfg.send_status_messages = True
+    cfg.reconnect_delay.min = 0.1
+    cfg.reconnect_delay.max = 30.
+    cfg.queue_ttl = 0
+    cfg.status_buffer_size = 2
+    for key, value in overrides.items():
+        setattr(cfg, key, value)
+    return cfg
+
+
+class MessageSourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Mock()
+        self.source = MessageSource(config=make_config(), metrics=self.metrics)
+
+    def connect(self, message_count=0):
+        self.source.connection = Mock()
+        self.source.channel = Mock()
+        self.source.publisher = Mock()
+        self.source._on_queue_created("queue", message_count, 0)
+
+    def test_reconnect_delay_backs_off(self):
+        delays = [self.source._get_reconnect_delay(failures)
+                  for failures in range(12)]
+
+        self.assertTrue(0.05 <= delays[0] <= 0.1)
+        self.assertTrue(0.4 <= delays[3] <= 0.8)
+        self.assertTrue(15 <= delays[11] <= 30)
+
+    def test_reconnect_delay_survives_long_outages(self):
+        delay = self.source._get_reconnect_delay(5000)
+        self.assertTrue(15 <= delay <= 30)
+
+    def test_temporary_queue_by_default(self):
+        self.assertEqual(self.source.queue_name, "")
+
+    def test_persistent_queue_with_ttl(self):
+        source = MessageSource(
+            config=make_config(queue_ttl=60), metrics=self.metrics)
+        self.assertTrue(source.queue_name.startswith("broadcast."))
+        self.assertEqual(source.queue_name, source.queue_name)
+
+    def test_persistent_queues_unique_per_process(self):
+        first = MessageSource(
+            config=make_config(queue_ttl=60), metrics=self.metrics)
+        second = MessageSource(
+            config=make_config(queue_ttl=60), metrics=self.metrics)
+        self.assertNotEqual(first.queue_name, second.queue_name)
+
+    def test_status_messages_buffered_while_disconnected(self):
+        self.source.send_message("websocket.connect", {"namespace": "/a"})
+        self.source.send_message("websocket.connect", {"namespace": "/b"})
+        self.source.send_message("websocket.connect", {"namespace": "/c"})
+
+        stats = self.source.get_stats()
+        self.assertEqual(stats["status_messages_pending"], 2)
+        self.assertEqual(stats["status_messages_dropped"], 1)
+        self.metrics.counter.assert_called_with("amqp.status.dropped")
+
+        self.connect()
+        self.assertEqual(self.source.publisher.publish.call_count, 2)
+        self.assertEqual(self.source.get_stats()["status_messages_pending"], 0)
+
+    def test_status_messages_sent_while_connected(self):
+        self.connect()
+        self.source.send_message("websocket.connect", {"namespace": "/a"})
+
+        self.assertEqual(self.source.publisher.publish.call_count, 1)
+
+    def test_reconnect_counts_recovered_messages(self):
+        self.connect()
+        self.source._on_close()
+        self.assertFalse(self.source.connected)
+        self.metrics.counter.assert_called_with("amqp.disconnect")
+
+        self.connect(message_count=5)
+
+        stats = self.source.get_stats()
+        self.assertEqual(stats["reconnects"], 1)
+        self.assertEqual(stats["messages_recovered"], 5)
+        self.metrics.timer.assert_called_with("amqp.reconnect")
+
+    def deliver(self, body, content_type=None):
+        self.source.message_handler = Mock()
+        message = Mock(body=bytearray(body),
+                       delivery_info={"routing_key": "/live"})
+        message.properties = {}
+        if content_type:
+            message.properties["content_type"] = content_type
+        self.source._on_message(message)
+        return self.source.message_handler
+
+    def test_text_messages_decoded(self):
+        handler = self.deliver("\xe2\x98\x83")
+        handler.assert_called_once_with(namespace="/live", message=u"\u2603")
+
+        handler = self.deliver("{}", "application/json; charset=utf-8")
+        handler.assert_called_once_with(namespace="/live", message=u"{}")
+
+    def test_binary_messages_passed_through(self):
+        handler = self.deliver("\x82\xa1", "application/x-msgpack")
+        handler.assert_called_once_with(
+            namespace="/live", message="\x82\xa1", binary=True)
+
+    @patch("gevent.sleep")
+    def test_pump_messages_fails_over(self, sleep):
+        attempted = []
+
+        def fail(endpoint):
+            attempted.append(endpoint.address.host)
+            if len(attempted) == 3:
+                raise KeyboardInterrupt
+            raise socket.error("connection refused")
+
+        self.source._connect = fail
+        with self.assertRaises(KeyboardInterrupt):
+            self.source.pump_messages()
+
+        self.assertEqual(attempted, ["127.0.0.1", "127.0.0.2", "127.0.0.1"])
+        self.assertEqual(sleep.call_count, 2)
@@ -0,0 +1,18 @@
+"""Unit tests for the stats renderers."""
+import unittest
+
+from reddit_service_websockets.stats import _format_labels
+
+
+class PrometheusLabelTests(unittest.TestCase):
+
+    def test_no_labels(self):
+        self.assertEqual(_format_labels({}), "")
+
+    def test_labels_sorted(self):
+        self.assertEqual(_format_labels({"b": "/b", "a": 1}),
+                         '{a="1",b="/b"}')
+
+    def test_label_values_escaped(self):
+        self.assertEqual(_format_labels({"prefix": 'a\\b"c\nd'}),
+                         '{prefix="a\\\\b\\"c\\nd"}')
@@ -0,0 +1,110 @@
+"""Unit tests for UnixSocketMessageSource."""
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+
+import gevent
+import gevent.socket
+from mock import Mock
+
+from reddit_service_websockets.unix_source import (
+    encode_frame,
+    MAX_FRAME_SIZE,
+    UnixSocketMessageSource,
+)
+
+
+class UnixSocketMessageSourceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = UnixSocketMessageSource(
+            config=Mock(directory=self.directory, mode=0o660),
+            metrics=Mock(),
+        )
+        self.received = []
+        self.source.message_handler = (
+            lambda namespace, message:
+                self.received.append((namespace, message)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_handles_complete_frames(self):
+        buf = bytearray(encode_frame("/live/abc", u"hello") +
+                        encode_frame("/live/def", u"\u2603"))
+
+        consumed = self.source._handle_frames(buf)
+
+        self.assertEqual(consumed, len(buf))
+        self.assertEqual(self.received, [
+            ("/live/abc", u"hello"),
+            ("/live/def", u"\u2603"),
+        ])
+
+    def test_leaves_partial_frames(self):
+        first = encode_frame("/live/abc", "hello")
+        second = encode_frame("/live/def", "world")
+        buf = bytearray(first + second[:-2])
+
+        consumed = self.source._handle_frames(buf)
+
+        self.assertEqual(consumed, len(first))
+        self.assertEqual(self.received, [("/live/abc", u"hello")])
+
+    def test_rejects_oversized_frames(self):
+        frame = bytearray(encode_frame("/live/abc", "hello"))
+        frame[0:4] = bytearray(b"\xff\xff\xff\xff")
+        self.assertGreater(0xffffffff, MAX_FRAME_SIZE)
+
+        self.assertEqual(self.source._handle_frames(frame), -1)
+        self.assertEqual(self.received, [])
+
+    def test_skips_undecodable_frames(self):
+        buf = bytearray(encode_frame("/live/abc", "\xff") +
+                        encode_frame("/live/def", "hello"))
+
+        self.assertEqual(self.source._handle_frames(buf), len(buf))
+        self.assertEqual(self.received, [("/live/def", u"hello")])
+        self.assertEqual(self.source.get_stats()["frames_rejected"], 1)
+
+    def test_passes_binary_frames_through(self):
+        self.source.message_handler = Mock()
+        buf = bytearray(encode_frame("/live/abc", "\x00\xff", binary=True))
+
+        self.assertEqual(self.source._handle_frames(buf), len(buf))
+        self.source.message_handler.assert_called_once_with(
+            namespace="/live/abc", message="\x00\xff", binary=True)
+
+    def test_receives_from_publishers(self):
+        server = gevent.spawn(self.source.pump_messages)
+        gevent.sleep(0.01)
+        self.assertTrue(self.source.connected)
+
+        publisher = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        publisher.connect(self.source.path)
+        publisher.sendall(encode_frame("/live/abc", "hello"))
+        publisher.close()
+        gevent.sleep(0.01)
+
+        self.assertEqual(self.received, [("/live/abc", u"hello")])
+        server.kill()
+
+    def test_socket_permissions(self):
+        server = gevent.spawn(self.source.pump_messages)
+        gevent.sleep(0.01)
+
+        mode = stat.S_IMODE(os.stat(self.source.path).st_mode)
+        self.assertEqual(mode, 0o660)
+        server.kill()
+
+    def test_close_removes_socket(self):
+        server = gevent.spawn(self.source.pump_messages)
+        gevent.sleep(0.01)
+
+        self.source.close()
+        self.assertFalse(os.path.exists(self.source.path))
+        server.kill()